@@ -0,0 +1 @@
+"""Benchmarks for Blink, each module is a script that can be run with python3 -m benchmarks.<name>"""
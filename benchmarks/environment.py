@@ -0,0 +1,104 @@
+"""A headless environment in which the message history runs on its own threads, without windows"""
+
+import os
+import time
+
+from threading import Event
+
+from PyQt6.QtCore import QCoreApplication
+from application.notification import NotificationCenter
+from application.python import Null
+from sipsimple.application import SIPApplication
+from sipsimple.configuration import ConfigurationManager
+from sipsimple.storage import MemoryStorage
+from sipsimple.threading import call_in_thread
+
+from blink.resources import ApplicationData
+
+
+__all__ = ['BenchmarkApplication', 'HistoryEnvironment']
+
+
+class BenchmarkApplication(QCoreApplication):
+    """Runs the functions that the history posts to the GUI thread, like its flush and vacuum timers"""
+
+    def customEvent(self, event):
+        handler = getattr(self, '_EH_%s' % event.name, Null)
+        handler(event)
+
+    def _EH_CallFunctionEvent(self, event):
+        event.function(*event.args, **event.kw)
+
+
+class HistoryEnvironment(object):
+    """Owns the application data directory and the message history singleton of one benchmark run"""
+
+    timeout = 300  # seconds
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.application = QCoreApplication.instance() or BenchmarkApplication([])
+        self.history = None
+
+    def start(self, account_ids):
+        ApplicationData._cached_directory = self.directory
+        os.makedirs(self.directory, exist_ok=True)
+        # The settings are only read by the history, they are kept in memory so that nothing outside the directory is touched
+        SIPApplication.storage = MemoryStorage()
+        ConfigurationManager().start()
+
+        from blink.history import MessageHistory
+        self.history = MessageHistory()
+        # There is no account manager, the generated accounts are the enabled ones
+        self.history._get_enabled_account_ids = lambda: list(account_ids)
+        self.call_in_db_thread(Null)
+
+    def stop(self):
+        if self.history is not None:
+            self.call_in_db_thread(self.history._flush_pending_messages)
+
+    def wait(self, event, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        while not event.is_set():
+            if time.monotonic() > deadline:
+                raise TimeoutError('the message history did not answer in time')
+            self.application.processEvents()
+            event.wait(0.001)
+
+    def call_in_db_thread(self, function, *args, **kw):
+        """Run function on the history writer thread after everything queued before it and return its result"""
+        done = Event()
+        result = []
+
+        def run():
+            try:
+                result.append(function(*args, **kw))
+            finally:
+                done.set()
+
+        call_in_thread('db', run)
+        self.wait(done)
+        if not result:
+            raise RuntimeError(f'{getattr(function, "__name__", function)} failed on the db thread')
+        return result[0]
+
+    def wait_for_notification(self, name, function, *args, **kw):
+        """Call function and wait for the notification it is expected to post, returning its data"""
+        notification_center = NotificationCenter()
+        received = Event()
+        data = []
+
+        class Observer(object):
+            def handle_notification(self, notification):
+                if not received.is_set():
+                    data.append(notification.data)
+                    received.set()
+
+        observer = Observer()
+        notification_center.add_observer(observer, name=name)
+        try:
+            function(*args, **kw)
+            self.wait(received)
+        finally:
+            notification_center.remove_observer(observer, name=name)
+        return data[0]
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+"""Time the message history queries used by the chat and contact windows on a synthetic database and report the results as JSON"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timezone
+from random import Random
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.environment import HistoryEnvironment
+from benchmarks.synthetic import SyntheticHistory, add_arguments, populate
+from blink.__info__ import __version__
+
+
+def summarize(times, count=None):
+    result = dict(runs=len(times), min=min(times), median=statistics.median(times), mean=statistics.mean(times), max=max(times))
+    if count is not None:
+        result['rows'] = count
+        result['rows_per_second'] = count / sum(times) if sum(times) else None
+    return result
+
+
+def measure(function, *args, **kw):
+    start = time.perf_counter()
+    result = function(*args, **kw)
+    return time.perf_counter() - start, result
+
+
+def run(environment, dataset, options):
+    history = environment.history
+    results = {}
+    random = Random(options.seed)
+
+    largest = dataset.largest_conversations(options.sample)
+    others = [conversation for conversation in dataset.conversations if conversation not in largest]
+    conversations = largest + random.sample(others, min(options.sample, len(others)))
+
+    times = []
+    for i in range(options.repeat):
+        for account_id, remote_uri, count in conversations:
+            session = SimpleNamespace(remote_instance_id=None)
+            elapsed, data = measure(environment.wait_for_notification, 'BlinkMessageHistoryLoadDidSucceed', history.load, remote_uri, session, entries=options.page)
+            times.append(elapsed)
+    results['load'] = summarize(times)
+
+    for name, function, notification, kw in [('get_last_contacts', history.get_last_contacts, 'BlinkMessageHistoryLastContactsDidSucceed', dict(number=25)),
+                                             ('get_last_contacts_unread', history.get_last_contacts, 'BlinkMessageHistoryLastContactsDidSucceed', dict(unread=True)),
+                                             ('get_all_contacts', history.get_all_contacts, 'BlinkMessageHistoryAllContactsDidSucceed', {}),
+                                             ('get_unread_messages', history.get_unread_messages, 'BlinkMessageHistoryUnreadMessagesDidLoad', {})]:
+        times = [measure(environment.wait_for_notification, notification, function, **kw)[0] for i in range(options.repeat)]
+        results[name] = summarize(times)
+
+    # New messages go to new conversations, the import path stores them in batches like the history writer does
+    insert = SyntheticHistory(len(dataset.account_ids), max(1, options.insert // 100), options.insert, dataset.exponent, 1, options.seed + 1)
+    messages = list(insert.iter_messages())
+    for fields in messages:
+        fields['remote_uri'] = fields['uri'] = 'new-' + fields['remote_uri']
+    times = []
+    inserted = 0
+    for index in range(0, len(messages), history.batch_size):
+        elapsed, stored = measure(lambda batch: history._import_messages(batch).result(), messages[index:index + history.batch_size])
+        times.append(elapsed)
+        inserted += stored
+    results['insert'] = summarize(times, inserted)
+
+    # Removing is destructive, each of the largest conversations is removed once
+    times = []
+    removed = 0
+    for account_id, remote_uri, count in largest:
+        account = SimpleNamespace(id=account_id)
+        elapsed, data = measure(environment.wait_for_notification, 'BlinkMessageHistoryRemoveDidEnd', history.remove_contact_messages, account, remote_uri)
+        times.append(elapsed)
+        removed += data.removed
+    results['remove_contact_messages'] = summarize(times, removed)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument('--database', help='directory with a message_history.db made by benchmarks.synthetic with the same options, it is copied before use')
+    parser.add_argument('--page', type=int, default=100, help='number of messages loaded per conversation (default %(default)s)')
+    parser.add_argument('--sample', type=int, default=10, help='number of large and of random conversations that are loaded (default %(default)s)')
+    parser.add_argument('--insert', type=int, default=10000, help='number of messages inserted (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every query (default %(default)s)')
+    parser.add_argument('--output', help='file where the JSON results are written (default standard output)')
+    options = parser.parse_args()
+
+    dataset = SyntheticHistory(options.accounts, options.conversations, options.messages, options.exponent, options.days, options.seed)
+    report = dict(benchmark='message_history', version=__version__, timestamp=datetime.now(timezone.utc).isoformat(),
+                  python=platform.python_version(), sqlite=sqlite3.sqlite_version, platform=platform.platform(),
+                  parameters=dict(page=options.page, sample=options.sample, insert=options.insert, repeat=options.repeat),
+                  dataset=dataset.describe())
+
+    with tempfile.TemporaryDirectory() as directory:
+        if options.database:
+            for name in ('message_history.db', 'message_history.db-wal', 'message_history_archive.db'):
+                if os.path.exists(os.path.join(options.database, name)):
+                    shutil.copy(os.path.join(options.database, name), directory)
+        environment = HistoryEnvironment(directory)
+        environment.start(dataset.account_ids)
+        try:
+            if not options.database:
+                elapsed, kinds = measure(populate, environment, dataset)
+                report['dataset'].update(kinds=kinds, generation_time=elapsed)
+            report['dataset']['size'] = os.path.getsize(os.path.join(directory, 'message_history.db'))
+            report['results'] = run(environment, dataset, options)
+        finally:
+            environment.stop()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
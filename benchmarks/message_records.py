@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+"""Compare the per row cost of message history reads and writes through SQLObject and through MessageStore"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlobject import connectionForURI
+
+from blink.history import Message, MessageRecord, MessageStore
+
+
+def generate_messages(count, remote_uri='bob@example.com'):
+    start = datetime(2020, 1, 1)
+    for index in range(count):
+        yield dict(message_id=f'message-{index}', account_id='alice@example.com', remote_uri=remote_uri, display_name='Bob', uri=remote_uri,
+                   timestamp=start + timedelta(seconds=index), direction='incoming' if index % 2 else 'outgoing', content=f'Message number {index} ' * 4,
+                   content_type='text/plain', state='displayed', decryption_error='', disposition='')
+
+
+def read_all_columns(message):
+    # The chat window touches most columns of every loaded message
+    return tuple(getattr(message, name) for name in MessageRecord.columns)
+
+
+def best_of(repeat, function):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000, help='number of messages in the database (default %(default)s)')
+    parser.add_argument('--page', type=int, default=1000, help='number of messages loaded per query (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs, the fastest one is reported (default %(default)s)')
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = connectionForURI(f"sqlite:{os.path.join(directory, 'messages.db')}")
+        Message._connection = db
+        Message.createTable()
+        store = MessageStore(db)
+        messages = list(generate_messages(options.rows))
+
+        def insert_sqlobject():
+            Message.deleteMany(None)
+            transaction = db.transaction()
+            for fields in messages:
+                Message(connection=transaction, **fields)
+            transaction.commit(close=True)
+
+        def insert_store():
+            Message.deleteMany(None)
+            with store.transaction() as connection:
+                for fields in messages:
+                    store.insert(connection, fields)
+
+        results = [('insert', 'sqlobject', best_of(options.repeat, insert_sqlobject), options.rows),
+                   ('insert', 'store', best_of(options.repeat, insert_store), options.rows)]
+
+        def load_sqlobject():
+            db.cache.clear()
+            result = Message.select(Message.q.remote_uri == 'bob@example.com').orderBy(['timestamp', 'message_id']).reversed()[:options.page]
+            for message in list(result)[::-1]:
+                read_all_columns(message)
+
+        def load_store():
+            with store.connection() as connection:
+                for message in store.load(connection, 'bob@example.com', options.page):
+                    read_all_columns(message)
+
+        results += [('load', 'sqlobject', best_of(options.repeat, load_sqlobject), options.page),
+                    ('load', 'store', best_of(options.repeat, load_store), options.page)]
+
+    print(f"{'operation':<10} {'layer':<10} {'total ms':>10} {'us/row':>10}")
+    for operation, layer, elapsed, rows in results:
+        print(f'{operation:<10} {layer:<10} {elapsed * 1000:>10.2f} {elapsed / rows * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+"""Generate a message_history.db with synthetic accounts and conversations"""
+
+import argparse
+import os
+import sys
+
+from collections import Counter
+from datetime import datetime, timedelta
+from random import Random
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+__all__ = ['SyntheticHistory', 'add_arguments', 'populate']
+
+
+words = ('hello', 'meeting', 'tomorrow', 'call', 'me', 'when', 'you', 'are', 'free', 'the', 'report', 'is', 'ready', 'thanks', 'see', 'later',
+         'lunch', 'today', 'file', 'sent', 'did', 'get', 'it', 'ok', 'sure', 'great', 'sorry', 'late', 'train', 'home', 'weekend', 'plans')
+
+
+class SyntheticHistory(object):
+    """A reproducible set of conversations whose sizes follow a Zipf distribution
+
+    The conversation of rank r holds a share of the messages proportional to 1/r**exponent,
+    so a few conversations are very long and most of them only have a handful of messages.
+    """
+
+    call_ratio = 0.08
+    encrypted_ratio = 0.1
+    long_ratio = 0.01
+    unread_ratio = 0.2  # of the conversations, each ends with a few unread incoming messages
+    shared_contact_ratio = 0.1  # of the conversations, their contact also talks to another account
+
+    def __init__(self, accounts=3, conversations=500, messages=100000, exponent=1.1, days=365, seed=0):
+        self.exponent = exponent
+        self.days = days
+        self.seed = seed
+        self.account_ids = [f'account{index}@example.com' for index in range(accounts)]
+        self.end = datetime(2024, 1, 1)
+
+        random = Random(seed)
+        weights = [1 / rank ** exponent for rank in range(1, conversations + 1)]
+        total = sum(weights)
+        counts = [max(1, int(messages * weight / total)) for weight in weights]
+        counts[0] += max(0, messages - sum(counts))
+
+        self.conversations = []
+        for index, count in enumerate(counts):
+            account_id = self.account_ids[index % accounts]
+            if index and random.random() < self.shared_contact_ratio:
+                remote_uri = self.conversations[random.randrange(index)][1]
+            else:
+                remote_uri = f'contact{index}@example.org'
+            self.conversations.append((account_id, remote_uri, count))
+
+    @property
+    def message_count(self):
+        return sum(count for account_id, remote_uri, count in self.conversations)
+
+    def largest_conversations(self, number):
+        return sorted(self.conversations, key=lambda conversation: conversation[2], reverse=True)[:number]
+
+    def iter_messages(self):
+        random = Random(self.seed)
+        for account_id, remote_uri, count in self.conversations:
+            display_name = remote_uri.partition('@')[0].title()
+            span = timedelta(days=self.days).total_seconds()
+            offsets = sorted(random.random() * span for i in range(count))
+            unread = random.randint(1, 5) if random.random() < self.unread_ratio else 0
+            for index, offset in enumerate(offsets):
+                direction = random.choice(('incoming', 'outgoing'))
+                if index >= count - unread:
+                    direction = 'incoming'
+                fields = dict(message_id=f'{random.getrandbits(128):032x}',
+                              account_id=account_id,
+                              remote_uri=remote_uri,
+                              display_name=display_name,
+                              uri=remote_uri,
+                              timestamp=self.end - timedelta(seconds=span - offset),
+                              direction=direction,
+                              content_type='text/plain',
+                              encryption_type='',
+                              decrypted='0',
+                              decryption_error='',
+                              disposition='')
+                kind = random.random()
+                if kind < self.call_ratio:
+                    seconds = random.randint(0, 3600)
+                    fields.update(content=str([""" (%d'%02d")""" % (seconds / 60, seconds % 60), '', random.choice(('audio', 'video'))]),
+                                  content_type='application/blink-call-history')
+                elif kind < self.call_ratio + self.encrypted_ratio:
+                    armor = ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/') for i in range(random.randint(300, 1200)))
+                    fields.update(content=f'-----BEGIN PGP MESSAGE-----\n\n{armor}\n-----END PGP MESSAGE-----\n', encryption_type="['OpenPGP']",
+                                  decrypted=random.choice('1123'))
+                    if fields['decrypted'] == '2':
+                        fields['decryption_error'] = 'No private key found'
+                elif kind < self.call_ratio + self.encrypted_ratio + self.long_ratio:
+                    fields['content'] = ' '.join(random.choice(words) for i in range(random.randint(1000, 3000)))
+                else:
+                    fields['content'] = ' '.join(random.choice(words) for i in range(random.randint(1, 30)))
+                if direction == 'incoming':
+                    fields['state'] = 'delivered' if index >= count - unread else 'displayed'
+                else:
+                    fields['state'] = random.choices(('displayed', 'delivered', 'failed'), weights=(80, 18, 2))[0] if fields['content_type'] == 'text/plain' else 'displayed'
+                yield fields
+
+    def describe(self):
+        return dict(accounts=len(self.account_ids), conversations=len(self.conversations), messages=self.message_count,
+                    contacts=len({remote_uri for account_id, remote_uri, count in self.conversations}),
+                    largest_conversation=max(count for account_id, remote_uri, count in self.conversations),
+                    exponent=self.exponent, days=self.days, seed=self.seed)
+
+
+def add_arguments(parser):
+    parser.add_argument('--accounts', type=int, default=3, help='number of accounts (default %(default)s)')
+    parser.add_argument('--conversations', type=int, default=500, help='number of conversations (default %(default)s)')
+    parser.add_argument('--messages', type=int, default=100000, help='number of messages (default %(default)s)')
+    parser.add_argument('--exponent', type=float, default=1.1, help='exponent of the Zipf distribution of the conversation sizes (default %(default)s)')
+    parser.add_argument('--days', type=int, default=365, help='number of days covered by the history (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator (default %(default)s)')
+
+
+def populate(environment, dataset, batch_size=1000):
+    """Store the messages of dataset through the history import path, returns the number of messages by content type"""
+    history = environment.history
+    kinds = Counter()
+    batch = []
+    for fields in dataset.iter_messages():
+        kinds['encrypted' if fields['encryption_type'] else fields['content_type']] += 1
+        batch.append(fields)
+        if len(batch) == batch_size:
+            history._import_messages(batch).result()
+            batch = []
+    if batch:
+        history._import_messages(batch).result()
+    environment.call_in_db_thread(history._flush_pending_messages)
+    return dict(kinds)
+
+
+def main():
+    from benchmarks.environment import HistoryEnvironment
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help='directory in which message_history.db is created, it must not contain one already')
+    add_arguments(parser)
+    options = parser.parse_args()
+
+    if os.path.exists(os.path.join(options.directory, 'message_history.db')):
+        parser.error(f'{options.directory} already contains a message history')
+
+    dataset = SyntheticHistory(options.accounts, options.conversations, options.messages, options.exponent, options.days, options.seed)
+    environment = HistoryEnvironment(os.path.abspath(options.directory))
+    environment.start(dataset.account_ids)
+    try:
+        kinds = populate(environment, dataset)
+    finally:
+        environment.stop()
+    print(f'Generated {dataset.message_count} messages in {len(dataset.conversations)} conversations: ' + ', '.join(f'{count} {kind}' for kind, count in sorted(kinds.items())))
+
+
+if __name__ == '__main__':
+    main()
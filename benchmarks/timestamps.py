@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+"""Compare the cost of normalising message timestamps to UTC by formatting and parsing them and with utc_timestamp, and of converting them to epoch microseconds"""
+
+import argparse
+import calendar
+import os
+import sys
+import timeit
+
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blink.history import epoch_microseconds, utc_timestamp
+
+
+def generate_timestamps(count):
+    # Server history timestamps carry the offset of whoever sent the message
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    offsets = [timezone(timedelta(hours=hours)) for hours in range(-11, 13)]
+    return [(start + timedelta(seconds=index * 37, microseconds=index)).astimezone(offsets[index % len(offsets)]) for index in range(count)]
+
+
+def parse_round_trip(value):
+    # The conversion done by the history writers before utc_timestamp
+    return parse(str(value.replace(tzinfo=timezone.utc) - value.utcoffset()))
+
+
+def calendar_epoch(value):
+    return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=10000, help='number of timestamps converted per run (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs, the fastest one is reported (default %(default)s)')
+    options = parser.parse_args()
+
+    timestamps = generate_timestamps(options.count)
+    normalized = [utc_timestamp(value) for value in timestamps]
+    assert normalized == [parse_round_trip(value).replace(tzinfo=None) for value in timestamps]
+    assert [epoch_microseconds(value) for value in normalized] == [calendar_epoch(value) for value in normalized]
+
+    cases = [('normalize', 'parse', lambda: [parse_round_trip(value) for value in timestamps]),
+             ('normalize', 'utc_timestamp', lambda: [utc_timestamp(value) for value in timestamps]),
+             ('epoch', 'timedelta', lambda: [calendar_epoch(value) for value in normalized]),
+             ('epoch', 'epoch_microseconds', lambda: [epoch_microseconds(value) for value in normalized])]
+
+    print(f"{'operation':<10} {'method':<20} {'total ms':>10} {'ns/value':>10}")
+    for operation, method, function in cases:
+        elapsed = min(timeit.repeat(function, number=1, repeat=options.repeat))
+        print(f'{operation:<10} {method:<20} {elapsed * 1000:>10.2f} {elapsed / options.count * 1e9:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -58,6 +58,7 @@ from blink.logging import MessagingTrace as log
 from blink.messages import MessageManager, BlinkMessage
 from blink.resources import ApplicationData, IconManager, Resources
 from blink.sessions import ChatSessionModel, ChatSessionListView, SessionManager, StreamDescription, FileSizeFormatter, IncomingDialogBase, RequestList, BlinkFileTransfer
+from blink.streams.message import DecryptionPool
 from blink.util import run_in_gui_thread, call_later, translate, copy_transfer_file
 from blink.widgets.color import ColorHelperMixin
 from blink.widgets.graph import Graph
@@ -1014,6 +1015,9 @@ class ChatWidget(base_class, ui_class):
         self.last_message = None
         self.session = session
         self.history_loaded = False
+        self.history_loading = False
+        self.history_more = False
+        self.history_cursor = None
         self.timestamp_rendered_messages = []
         self.pending_decryption = []
         self.remove_requests = RequestList()
@@ -1030,6 +1034,7 @@ class ChatWidget(base_class, ui_class):
         self.chat_view.sizeChanged.connect(self._SH_ChatViewSizeChanged)
 
         self.chat_view.page().contentsSizeChanged.connect(self._SH_ChatViewFrameContentsSizeChanged)
+        self.chat_view.page().scrollPositionChanged.connect(self._SH_ChatViewScrollPositionChanged)
         self.chat_view.page().linkClicked.connect(self._SH_LinkClicked)
         self.chat_js.contextMenuEvent.connect(self._SH_ContextMenuEvent)
 
@@ -1351,6 +1356,15 @@ class ChatWidget(base_class, ui_class):
         self._align_chat(scroll=size.height() > self.size.height())
         self.size = size
 
+    def _SH_ChatViewScrollPositionChanged(self, position):
+        # Reaching the top of the conversation pulls in the previous page of history
+        if position.y() > 0 or self.session is None or not self.history_loaded or not self.history_more or self.history_loading:
+            return
+        self.history_loading = True
+        timestamp, message_id = self.history_cursor
+        blink_session = self.session.blink_session
+        HistoryManager().load_before(blink_session.contact.uri.uri, blink_session, timestamp, message_id)
+
     def _SH_ChatInputTextChanged(self):
         if self.session.blink_session.chat_type is None:
             manager = MessageManager()
@@ -2153,6 +2167,8 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         notification_center.add_observer(self, name='BlinkMessageDidFail')
         notification_center.add_observer(self, name='BlinkMessageHistoryLoadDidSucceed')
         notification_center.add_observer(self, name='BlinkMessageHistoryLoadDidFail')
+        notification_center.add_observer(self, name='BlinkMessageHistoryLoadBeforeDidSucceed')
+        notification_center.add_observer(self, name='BlinkMessageHistoryLoadBeforeDidFail')
         notification_center.add_observer(self, name='BlinkMessageHistoryLastContactsDidSucceed')
         notification_center.add_observer(self, name='BlinkMessageHistoryCallHistoryDidStore')
         notification_center.add_observer(self, name='BlinkConversationWillRemove')
@@ -2319,6 +2335,7 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             self.otr_widget.hide()
             self.zrtp_widget.hide()
             self.zrtp_widget.stream_type = None
+            DecryptionPool().prioritize(new_session.blink_session if new_session is not None else None)
             notification_center = NotificationCenter()
             if old_session is not None:
                 notification_center.remove_observer(self, sender=old_session)
@@ -3216,12 +3233,6 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             else:
                 self.pending_displayed_notifications.setdefault(blink_session, []).append((message.id, message.timestamp, received_account))
 
-        if direction == 'incoming':
-            if self.selected_session is session and not self.isMinimized() and self.isActiveWindow():
-                pass
-            else:
-                NotificationCenter().post_notification('BlinkMessageNewUnread', sender=uri)
-
         if direction != 'outgoing':
             if self.selected_session is session and not self.isMinimized() and self.isActiveWindow():
                 pass
@@ -3414,16 +3425,9 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             if stream and (stream.can_decrypt or stream.can_decrypt_with_others):
                 stream.decrypt(message)
 
-    def _NH_BlinkMessageHistoryLoadDidSucceed(self, notification):
-        blink_session = notification.sender
-        session = blink_session.items.chat
-
-        messages = notification.data.messages
+    def _add_history_messages(self, blink_session, session, messages):
         account_manager = AccountManager()
 
-        if session is None:
-            return
-
         last_account = None
         last_timestamp = None
         newest_timestamp = None
@@ -3530,6 +3534,25 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
                 session.chat_widget.update_message_encryption(message.message_id, True)
             elif 'OTR' in message.encryption_type:
                 session.chat_widget.update_message_encryption(message.message_id, True)
+
+        if messages:
+            cursor = (messages[0].timestamp, messages[0].message_id)
+            if session.chat_widget.history_cursor is None or cursor < session.chat_widget.history_cursor:
+                session.chat_widget.history_cursor = cursor
+
+        return last_account, newest_timestamp
+
+    def _NH_BlinkMessageHistoryLoadDidSucceed(self, notification):
+        blink_session = notification.sender
+        session = blink_session.items.chat
+
+        messages = notification.data.messages
+
+        if session is None:
+            return
+
+        last_account, newest_timestamp = self._add_history_messages(blink_session, session, messages)
+        session.chat_widget.history_more = getattr(notification.data, 'more', session.chat_widget.history_more)
         session.chat_widget.history_loaded = True
 
         while self.render_after_load:
@@ -3565,6 +3588,27 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         session.chat_widget.history_loaded = True
         session.chat_widget.show_loading_screen(False)
 
+    def _NH_BlinkMessageHistoryLoadBeforeDidSucceed(self, notification):
+        blink_session = notification.sender
+        session = blink_session.items.chat
+
+        if session is None or session.chat_widget is None:
+            return
+
+        self._add_history_messages(blink_session, session, notification.data.messages)
+        session.chat_widget.history_more = notification.data.more
+        session.chat_widget.history_loading = False
+        session.chat_widget._align_chat()
+
+    def _NH_BlinkMessageHistoryLoadBeforeDidFail(self, notification):
+        blink_session = notification.sender
+        session = blink_session.items.chat
+
+        if session is None or session.chat_widget is None:
+            return
+
+        session.chat_widget.history_loading = False
+
     def _NH_BlinkMessageHistoryLastContactsDidSucceed(self, notification):
         contacts = notification.data.contacts
         message_manager = MessageManager()
@@ -3623,6 +3667,10 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             session.chat_widget.timestamp_rendered_messages = []
 
             session.chat_widget.chat_js.empty_element('#chat')
+        # the conversation is loaded from its newest messages again when it is reopened
+        session.chat_widget.history_cursor = None
+        session.chat_widget.history_more = False
+        session.chat_widget.history_loading = False
 
     def _NH_ChatStreamGotMessage(self, notification):
         blink_session = notification.sender.blink_session
@@ -77,6 +77,7 @@ class SMSSettingsExtension(SMSSettings):
     history_synchronization_token = Setting(type=str, default=None, nillable=True)
     history_synchronization_id = Setting(type=str, default=None, nillable=True)
     history_synchronization_timestamp = RuntimeSetting(type=str, default=None, nillable=True)
+    history_retention = Setting(type=NonNegativeInteger, default=0)
 
 
 class SoundSettings(SettingsGroup):
@@ -13,7 +13,7 @@ from sipsimple.configuration.settings import SIPSimpleSettings
 from blink.resources import ApplicationData
 
 
-__all__ = ['ApplicationDataPath', 'DefaultPath', 'SoundFile', 'CustomSoundFile', 'HTTPURL', 'FileURL', 'IconDescriptor', 'PresenceState', 'PresenceStateList', 'GraphTimeScale', 'File']
+__all__ = ['ApplicationDataPath', 'DefaultPath', 'SoundFile', 'CustomSoundFile', 'HTTPURL', 'FileURL', 'IconDescriptor', 'PresenceState', 'PresenceStateList', 'RetentionPolicy', 'RetentionPolicyList', 'GraphTimeScale', 'File']
 
 
 class ApplicationDataPath(str):
@@ -201,6 +201,39 @@ class PresenceStateList(List):
     type = PresenceState
 
 
+# Number of days messages of a content type are kept, a content type ending in /* matches all its subtypes
+class RetentionPolicy(object):
+    def __init__(self, content_type, days):
+        days = int(days)
+        if days < 0:
+            raise ValueError("expected a non-negative number of days, found %d" % days)
+        self.content_type = str(content_type)
+        self.days = days
+
+    def __getstate__(self):
+        return '%s,%d' % (self.content_type, self.days)
+
+    def __setstate__(self, data):
+        content_type, days = data.rsplit(',', 1)
+        self.__init__(content_type, days)
+
+    def __eq__(self, other):
+        if isinstance(other, RetentionPolicy):
+            return self.content_type == other.content_type and self.days == other.days
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return NotImplemented if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.content_type, self.days)
+
+
+class RetentionPolicyList(List):
+    type = RetentionPolicy
+
+
 class GraphTimeScale(int):
     min_value = 2
     max_value = 4
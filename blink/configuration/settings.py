@@ -11,7 +11,7 @@ from sipsimple.configuration.datatypes import AudioCodecList, NonNegativeInteger
 from sipsimple.configuration.settings import AudioSettings, ChatSettings, EchoCancellerSettings, LogsSettings, RTPSettings, SIPSettings, TLSSettings
 
 from blink import __version__
-from blink.configuration.datatypes import ApplicationDataPath, GraphTimeScale, HTTPURL, IconDescriptor, SoundFile, PresenceState, PresenceStateList
+from blink.configuration.datatypes import ApplicationDataPath, GraphTimeScale, HTTPURL, IconDescriptor, SoundFile, PresenceState, PresenceStateList, RetentionPolicyList
 from blink.resources import Resources
 
 try:
@@ -118,6 +118,15 @@ class ChatWindowSettings(SettingsGroup):
     font_size = Setting(type=int, default=None, nillable=True)
 
 
+class BlinkMessageHistorySettings(SettingsGroup):
+    compression = Setting(type=bool, default=False)
+    compression_threshold = Setting(type=PositiveInteger, default=4096)
+    archive_after = Setting(type=NonNegativeInteger, default=0)
+    retention = Setting(type=RetentionPolicyList, default=RetentionPolicyList())
+    download_cache_size = Setting(type=NonNegativeInteger, default=0)  # MB, 0 keeps every downloaded file
+    sync_concurrency = Setting(type=PositiveInteger, default=4)  # accounts synchronized with the server at the same time
+
+
 class BlinkScreenSharingSettings(SettingsGroup):
     scale = Setting(type=bool, default=True)
     open_fullscreen = Setting(type=bool, default=False)
@@ -141,6 +150,7 @@ class BlinkSettings(SettingsObject):
     __id__ = 'BlinkSettings'
 
     chat_window = ChatWindowSettings
+    message_history = BlinkMessageHistorySettings
     presence = BlinkPresenceSettings
     screen_sharing = BlinkScreenSharingSettings
     interface = BlinkInterfaceSettings
@@ -315,16 +315,16 @@ class MessageContactsManager(object, metaclass=Singleton):
         if notification.sender is BonjourAccount():
             return
 
-        uri = notification.data.remote_uri
-        contact, contact_uri = URIUtils.find_contact(uri)
-        if contact.type in ['dummy']:
-            display_name = uri
-            contact = Contact(MessageContact(display_name, [contact_uri], uri), None)
-        try:
-            self.contacts[contact.settings.id]
-        except KeyError:
-            self.contacts.add(contact.settings)
-            notification.center.post_notification('MessageContactsManagerDidAddContact', sender=self, data=NotificationData(contact=contact.settings))
+        for uri in {message.remote_uri for message in notification.data.messages}:
+            contact, contact_uri = URIUtils.find_contact(uri)
+            if contact.type in ['dummy']:
+                display_name = uri
+                contact = Contact(MessageContact(display_name, [contact_uri], uri), None)
+            try:
+                self.contacts[contact.settings.id]
+            except KeyError:
+                self.contacts.add(contact.settings)
+                notification.center.post_notification('MessageContactsManagerDidAddContact', sender=self, data=NotificationData(contact=contact.settings))
 
     def _NH_AddressbookContactWasCreated(self, notification):
         contact = notification.sender
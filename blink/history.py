@@ -1,18 +1,32 @@
 
+import base64
 import bisect
+import hashlib
+import io
+import json
 import pickle as pickle
 import os
+import random
 import re
+import shutil
+import sqlite3
+import threading
+import time
 import uuid
+
+from concurrent.futures import Future
+from contextlib import contextmanager
 from PyQt6.QtCore import QTimer
 from PyQt6.QtGui import QIcon
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
+from application.python.decorator import decorator, preserve_signature
+from application.python.threadpool import ThreadPool
 from application.python.types import Singleton
 from application.system import host, makedirs, unlink
 
-from datetime import date, timezone
+from datetime import date, datetime, timedelta, timezone
 from dateutil.parser import parse
 from dateutil.tz import tzlocal
 from zope.interface import implementer
@@ -28,14 +42,21 @@ from blink.configuration.settings import BlinkSettings
 from blink.logging import MessagingTrace as log
 from blink.messages import BlinkMessage
 from blink.resources import ApplicationData, Resources
-from blink.sessions import BlinkSession
+from blink.sessions import BlinkSession, SessionManager
 
 from blink.util import run_in_gui_thread, translate
 import traceback
 
-from sqlobject import SQLObject, StringCol, DateTimeCol, IntCol, UnicodeCol, DatabaseIndex, AND
+from sqlobject import SQLObject, BoolCol, StringCol, DateTimeCol, IntCol, UnicodeCol, DatabaseIndex, AND, IN, OR
 from sqlobject import connectionForURI
 from sqlobject import dberrors
+from sqlobject.col import SOUnicodeCol, UnicodeStringValidator
+from sqlobject.sqlbuilder import NoDefault
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 __all__ = ['HistoryManager']
 
@@ -48,6 +69,7 @@ class HistoryManager(object, metaclass=Singleton):
 
     def __init__(self):
         self.calls = []
+        self.call_history = CallHistory()
         self.message_history = MessageHistory()
         self.download_history = DownloadHistory()
 
@@ -66,6 +88,7 @@ class HistoryManager(object, metaclass=Singleton):
         notification_center.add_observer(self, name='BlinkMessageDidFail')
         notification_center.add_observer(self, name='BlinkMessageDidEncrypt')
         notification_center.add_observer(self, name='BlinkMessageDidDecrypt')
+        notification_center.add_observer(self, name='PGPMessageDidDecrypt')
         notification_center.add_observer(self, name='BlinkMessageDidNotDecrypt')
         notification_center.add_observer(self, name='BlinkMessageWillDelete')
         notification_center.add_observer(self, name='BlinkConversationWillRemove')
@@ -75,29 +98,40 @@ class HistoryManager(object, metaclass=Singleton):
         notification_center.add_observer(self, name='BlinkGotHistoryMessageDelete')
         notification_center.add_observer(self, name='BlinkGotHistoryMessageUpdate')
         notification_center.add_observer(self, name='BlinkGotHistoryConversationRemove')
+        notification_center.add_observer(self, name='BlinkServerHistoryBatchDidEnd')
         notification_center.add_observer(self, name='BlinkFileTransferDidEnd')
         notification_center.add_observer(self, name='BlinkHTTPFileTransferDidEnd')
         notification_center.add_observer(self, name='BlinkMessageContactsDidChange')
         notification_center.add_observer(self, name='MessageContactsManagerDidActivate')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
-
-    @run_in_thread('file-io')
-    def save(self):
-        with open(ApplicationData.get('calls_history'), 'wb+') as history_file:
-            pickle.dump(self.calls, history_file)
+        notification_center.add_observer(self, sender=self.call_history)
 
     def load(self, uri, session, entries=100):
         return self.message_history.load(uri, session, entries=entries)
 
+    def load_before(self, uri, session, timestamp, message_id, entries=100):
+        return self.message_history.load_before(uri, timestamp, message_id, page_size=entries, session=session)
+
     def reload_pending_encrypted(self, uri, session, entries=100):
         return self.message_history.reload_pending_encrypted(uri, session, entries=entries)
 
     def get_last_contacts(self, number=10, unread=False):
         return self.message_history.get_last_contacts(number, unread=unread)
 
+    def search(self, query, account=None, remote_uri=None, limit=50, offset=0):
+        return self.message_history.search(query, account=account, remote_uri=remote_uri, limit=limit, offset=offset)
+
     def get_decrypted_filename(self, file):
         return self.download_history.get_decrypted_filename(file)
 
+    def load_calls(self, cursor=None, count=50, uri=None, account=None, text=None):
+        return self.call_history.load(cursor=cursor, count=count, uri=uri, account=account, text=text)
+
+    def _evict_downloads(self):
+        # the files of the conversations that have a session are kept
+        protected = {(str(session.account.id), DownloadHistory._remote_uri(session)) for session in SessionManager().sessions if session.account is not None and session.contact_uri is not None}
+        self.download_history.evict(protected)
+
     @run_in_gui_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -111,11 +145,22 @@ class HistoryManager(object, metaclass=Singleton):
                 self.message_history.reset_decryption(str(account.id))
             if 'enabled' in notification.data.modified:
                 self.message_history.get_unread_messages()
+            if 'sms.history_retention' in notification.data.modified:
+                self.message_history.apply_retention()
+        elif isinstance(notification.sender, BlinkSettings):
+            if 'message_history.compression' in notification.data.modified and notification.sender.message_history.compression:
+                self.message_history.compress_history()
+            if {'message_history.archive_after', 'message_history.retention'}.intersection(notification.data.modified):
+                self.message_history.apply_retention()
+            if 'message_history.download_cache_size' in notification.data.modified:
+                self._evict_downloads()
 
 
     def _NH_SIPApplicationDidStart(self, notification):
+        # Calls used to be kept in a pickled list, move them to the call history table once
+        filename = ApplicationData.get('calls_history')
         try:
-            data = pickle.load(open(ApplicationData.get('calls_history'), "rb"))
+            data = pickle.load(open(filename, "rb"))
             if not isinstance(data, list) or not all(isinstance(item, HistoryEntry) and item.text and isinstance(item.call_time, ISOTimestamp) for item in data):
                 raise ValueError("invalid save data")
         except FileNotFoundError:
@@ -123,9 +168,14 @@ class HistoryManager(object, metaclass=Singleton):
         except Exception as e:
             traceback.print_exc()
         else:
-            self.calls = data[-self.history_size:]
+            self.call_history.migrate(data, filename)
+        self.call_history.get_recent(self.history_size)
         self.message_history._retry_failed_messages()
         self.message_history.get_unread_messages()
+        if BlinkSettings().message_history.compression:
+            self.message_history.compress_history()
+        self.message_history.apply_retention()
+        self._evict_downloads()
 
     def _NH_SIPSessionDidEnd(self, notification):
         if notification.sender.account is BonjourAccount():
@@ -134,7 +184,7 @@ class HistoryManager(object, metaclass=Singleton):
         entry = HistoryEntry.from_session(session)
         bisect.insort(self.calls, entry)
         self.calls = self.calls[-self.history_size:]
-        self.save()
+        self.call_history.add(entry)
         self.message_history.add_call_history_entry(entry, session)
 
     def _NH_SIPSessionDidFail(self, notification):
@@ -156,9 +206,17 @@ class HistoryManager(object, metaclass=Singleton):
             entry.failed = True
         bisect.insort(self.calls, entry)
         self.calls = self.calls[-self.history_size:]
-        self.save()
+        self.call_history.add(entry)
         self.message_history.add_call_history_entry(entry, session)
 
+    def _NH_BlinkCallHistoryRecentDidLoad(self, notification):
+        # Calls that ended while the history was loading are already in the list
+        calls = {(entry.uri, entry.call_time) for entry in self.calls}
+        for entry in notification.data.entries:
+            if (entry.uri, entry.call_time) not in calls:
+                bisect.insort(self.calls, entry)
+        self.calls = self.calls[-self.history_size:]
+
     def _NH_ChatStreamGotMessage(self, notification):
         message = notification.data.message
 
@@ -216,6 +274,10 @@ class HistoryManager(object, metaclass=Singleton):
     def _NH_BlinkGotHistoryMessageUpdate(self, notification):
         self.message_history.update_message(notification)
 
+    def _NH_BlinkServerHistoryBatchDidEnd(self, notification):
+        # The messages of the batch were queued before this notification, the checkpoint is saved once they are stored
+        self.message_history.save_synchronization_checkpoint(notification.sender, notification.data.last_id)
+
     def _NH_BlinkMessageDidSucceed(self, notification):
         data = notification.data
         self.message_history.update(data.id, 'accepted')
@@ -233,6 +295,10 @@ class HistoryManager(object, metaclass=Singleton):
     def _NH_BlinkMessageDidDecrypt(self, notification):
         self.message_history.update_encryption(notification, decrypted=True)
 
+    def _NH_PGPMessageDidDecrypt(self, notification):
+        if isinstance(notification.data.message, MessageRecord):
+            self.message_history.update_decrypted_content(notification.data.message)
+
     def _NH_BlinkMessageDidNotDecrypt(self, notification):
         self.message_history.update_encryption(notification, decrypted=False)
 
@@ -262,7 +328,8 @@ class HistoryManager(object, metaclass=Singleton):
                 self.download_history.add(notification.sender)
 
     def _NH_BlinkHTTPFileTransferDidEnd(self, notification):
-        self.download_history.add_file(notification.sender, notification.data.file)
+        self.download_history.add_file(notification.sender, notification.data.file, content_key=notification.data.content_key)
+        self._evict_downloads()
 
     def _NH_BlinkMessageContactsDidChange(self, notification):
         self.message_history.get_all_contacts()
@@ -271,6 +338,47 @@ class HistoryManager(object, metaclass=Singleton):
         self.message_history.get_all_contacts()
 
 
+zstd_magic = b'\x28\xb5\x2f\xfd'
+epoch = datetime(1970, 1, 1)
+microsecond = timedelta(microseconds=1)
+
+
+def utc_timestamp(value):
+    """Return value as a naive datetime in UTC, the form in which the history stores timestamps. Naive values are already in UTC."""
+    offset = value.utcoffset()
+    if offset is None:
+        return value
+    return (value - offset).replace(tzinfo=None)
+
+
+def epoch_microseconds(value):
+    """Return the naive UTC datetime value as the number of microseconds since the epoch"""
+    return (value - epoch) // microsecond
+
+
+def decompress_text(value):
+    if zstandard is None:
+        raise RuntimeError('message is compressed but the zstandard module is not installed')
+    return zstandard.ZstdDecompressor().decompress(value).decode()
+
+
+class CompressedTextValidator(UnicodeStringValidator):
+    # Compressed values are stored as zstd frames in BLOBs, text values are returned unchanged
+    def to_python(self, value, state):
+        if isinstance(value, bytes) and value.startswith(zstd_magic):
+            return decompress_text(value)
+        return super(CompressedTextValidator, self).to_python(value, state)
+
+
+class SOCompressedUnicodeCol(SOUnicodeCol):
+    def createValidators(self):
+        return [CompressedTextValidator(name=self.name)] + super(SOUnicodeCol, self).createValidators()
+
+
+class CompressedUnicodeCol(UnicodeCol):
+    baseClass = SOCompressedUnicodeCol
+
+
 class TableVersion(SQLObject):
     class sqlmeta:
         table = 'table_versions'
@@ -288,16 +396,25 @@ class Message(SQLObject):
     uri             = UnicodeCol(length=128, default='')
     timestamp       = DateTimeCol()
     direction       = StringCol()
-    content         = UnicodeCol(sqlType='LONGTEXT')
+    content         = CompressedUnicodeCol(sqlType='LONGTEXT')
     content_type    = StringCol(default='text')
     state           = StringCol(default='pending')
     encryption_type = StringCol(default='')
     decrypted       = StringCol(default='0')
-    decryption_error= StringCol(sqlType='LONGTEXT')
+    decryption_error= CompressedUnicodeCol(sqlType='LONGTEXT')
     disposition     = StringCol(default='')
+    attempts        = IntCol(default=0)
+    next_attempt    = DateTimeCol(default=None)
+    timestamp_us    = IntCol(default=None)  # the timestamp in microseconds since the epoch
     remote_idx      = DatabaseIndex('remote_uri')
     id_idx          = DatabaseIndex('message_id')
     unq_idx         = DatabaseIndex(message_id, account_id, remote_uri, unique=True)
+    remote_timestamp_idx = DatabaseIndex(remote_uri, timestamp)
+
+
+class ArchivedMessage(Message):
+    class sqlmeta:
+        table = 'archive.messages'
 
 
 class DownloadedFiles(SQLObject):
@@ -307,8 +424,215 @@ class DownloadedFiles(SQLObject):
     account_id         = UnicodeCol(length=128)
     remote_uri         = UnicodeCol(length=128)
     filename           = UnicodeCol()
+    content_key        = StringCol(default=None)
+    last_access        = DateTimeCol(default=None)
     id_idx             = DatabaseIndex('file_id')
     unq_idx            = DatabaseIndex(file_id, filename, account_id, unique=True)
+    content_key_idx    = DatabaseIndex('content_key')
+
+
+class Call(SQLObject):
+    class sqlmeta:
+        table = 'calls'
+    direction          = StringCol()
+    uri                = UnicodeCol(length=128)
+    display_name       = UnicodeCol(length=128, default='')
+    account_id         = UnicodeCol(length=128)
+    call_time          = DateTimeCol()
+    duration           = IntCol(default=None)
+    failed             = BoolCol(default=False)
+    reason             = UnicodeCol(length=128, default='')
+    media              = StringCol(default='')
+    time_idx           = DatabaseIndex(call_time)
+    uri_time_idx       = DatabaseIndex(uri, call_time)
+    account_time_idx   = DatabaseIndex(account_id, call_time)
+
+
+class Conversation(SQLObject):
+    class sqlmeta:
+        table = 'conversations'
+    account_id         = UnicodeCol(length=128)
+    remote_uri         = UnicodeCol(length=128)
+    display_name       = UnicodeCol(length=128, default='')
+    last_timestamp     = DateTimeCol()
+    unread             = IntCol(default=0)
+    preview            = UnicodeCol(sqlType='TEXT', default='')
+    unq_idx            = DatabaseIndex(account_id, remote_uri, unique=True)
+    remote_idx         = DatabaseIndex(remote_uri)
+    timestamp_idx      = DatabaseIndex(last_timestamp)
+
+
+class PendingMessage(object):
+    __slots__ = 'fields', 'sender', 'kind', 'notify', 'replace_content', 'attempts'
+
+    def __init__(self, fields, sender, kind, notify=True, replace_content=False):
+        self.fields = fields
+        self.sender = sender
+        self.kind = kind
+        self.notify = notify
+        self.replace_content = replace_content
+        self.attempts = 0
+
+
+def database_is_busy(error):
+    """Whether a SQLite error is caused by another connection holding a lock, which goes away by itself"""
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return isinstance(error, sqlite3.OperationalError) and 'is locked' in str(error)
+
+
+class MessageRecord(object):
+    """A row of the messages table, read without creating SQLObject instances"""
+
+    columns = ('id', 'message_id', 'account_id', 'remote_uri', 'display_name', 'uri', 'timestamp', 'direction', 'content', 'content_type',
+               'state', 'encryption_type', 'decrypted', 'decryption_error', 'disposition', 'attempts', 'next_attempt', 'timestamp_us')
+    __slots__ = columns + ('is_secure',)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(id={self.id!r}, message_id={self.message_id!r}, remote_uri={self.remote_uri!r}, state={self.state!r})'
+
+    @staticmethod
+    def _text(value):
+        if isinstance(value, bytes):
+            return decompress_text(value) if value.startswith(zstd_magic) else value.decode()
+        return value
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        # usable as the row factory of a cursor that selects MessageStore.columns
+        record = cls.__new__(cls)
+        (record.id, record.message_id, record.account_id, record.remote_uri, record.display_name, record.uri, timestamp, record.direction, content, record.content_type,
+         record.state, record.encryption_type, record.decrypted, decryption_error, record.disposition, record.attempts, next_attempt, record.timestamp_us) = row
+        record.timestamp = datetime.fromisoformat(timestamp)
+        record.next_attempt = datetime.fromisoformat(next_attempt) if next_attempt is not None else None
+        record.content = cls._text(content)
+        record.decryption_error = cls._text(decryption_error)
+        record.is_secure = False
+        return record
+
+
+class MessageStore(object):
+    """Reads and writes the messages table with plain SQLite statements, for the queries that run most often"""
+
+    timestamp_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, db):
+        self.db = db
+        self.table = Message.sqlmeta.table
+        self.fields = MessageRecord.columns[1:]
+        self.defaults = {column.name: column.default for column in Message.sqlmeta.columnList if column.default is not NoDefault}
+        self.select_columns = ', '.join(MessageRecord.columns)
+        # The statements are constant strings, so the sqlite3 module prepares each of them once per connection
+        self.insert_query = f"insert into {self.table} ({', '.join(self.fields)}) values ({', '.join('?' for field in self.fields)}) on conflict do nothing"
+
+    @contextmanager
+    def connection(self):
+        # The SQLite connection SQLObject keeps for the calling thread, SQLObject must not be used on the thread until it is released
+        connection = self.db.getConnection()
+        try:
+            yield connection
+        finally:
+            self.db.releaseConnection(connection)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            connection.execute('begin')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('rollback')
+                raise
+            else:
+                connection.execute('commit')
+
+    def _value(self, value):
+        return value.strftime(self.timestamp_format) if isinstance(value, datetime) else value
+
+    def load(self, connection, remote_uri, count, before=None, schema='main', pending_decryption=False):
+        # The newest messages are read backwards from the (remote_uri, timestamp, message_id) index and returned oldest first
+        conditions = ["remote_uri = ?", "state != 'deleted'"]
+        parameters = [remote_uri]
+        if pending_decryption:
+            conditions.append("decrypted = '3'")
+        if before is not None:
+            timestamp, message_id = before
+            timestamp = self._value(timestamp)
+            conditions.append('(timestamp < ? or (timestamp = ? and message_id < ?))')
+            parameters += [timestamp, timestamp, message_id]
+        cursor = connection.cursor()
+        cursor.row_factory = MessageRecord.from_row
+        query = f"select {self.select_columns} from {schema}.{self.table} where {' and '.join(conditions)} order by timestamp desc, message_id desc limit ?"
+        return cursor.execute(query, parameters + [count]).fetchall()[::-1]
+
+    def insert(self, connection, fields):
+        # Returns None for a message that is already stored
+        fields = dict(self.defaults, **fields)
+        if fields['timestamp_us'] is None:
+            fields['timestamp_us'] = epoch_microseconds(fields['timestamp'])
+        values = tuple(self._value(fields[name]) for name in self.fields)
+        cursor = connection.execute(self.insert_query, values)
+        if cursor.rowcount == 0:
+            return None
+        return MessageRecord.from_row(cursor, (cursor.lastrowid,) + values)
+
+    def replace_content(self, connection, message_id, content):
+        row = connection.execute(f'select id, content from {self.table} where message_id = ? order by id limit 1', (message_id,)).fetchone()
+        if row is not None and MessageRecord._text(row[1]) != content:
+            connection.execute(f'update {self.table} set content = ? where id = ?', (content, row[0]))
+
+    def update_content(self, connection, message_id, account_id, remote_uri, content, schemas=('main',)):
+        for schema in schemas:
+            connection.execute(f'update {schema}.{self.table} set content = ? where message_id = ? and account_id = ? and remote_uri = ?', (content, message_id, account_id, remote_uri))
+
+    def incoming_remote_uris(self, connection, message_ids, chunk_size=500):
+        message_ids = list(message_ids)
+        remote_uris = set()
+        for index in range(0, len(message_ids), chunk_size):
+            chunk = message_ids[index:index + chunk_size]
+            query = f"select distinct remote_uri from {self.table} where direction = 'incoming' and message_id in ({', '.join('?' for id in chunk)})"
+            remote_uris.update(remote_uri for (remote_uri,) in connection.execute(query, chunk))
+        return remote_uris
+
+    def update_states(self, connection, updates):
+        # The updates are applied in order, each one checked against the state left by the previous ones.
+        # Outgoing messages are never marked as received and displayed messages only change when they are deleted.
+        query = f"""update {self.table} set state = :state where message_id = :id and state != :state
+                   and not (direction = 'outgoing' and :state = 'received') and (:state = 'deleted' or state != 'displayed')"""
+        cursor = connection.executemany(query, [dict(id=id, state=state) for (id, state) in updates])
+        return cursor.rowcount
+
+    def unread_counts(self, connection, account_ids, remote_uris=None):
+        # The unread counters are maintained by the conversations table triggers
+        parameters = list(account_ids)
+        condition = f"account_id in ({', '.join('?' for account_id in account_ids)})"
+        if remote_uris is None:
+            condition += ' and unread > 0'
+        else:
+            parameters += remote_uris
+            condition += f" and remote_uri in ({', '.join('?' for remote_uri in remote_uris)})"
+        query = f'select remote_uri, sum(unread) from {Conversation.sqlmeta.table} where {condition} group by remote_uri'
+        return dict(connection.execute(query, parameters).fetchall())
+
+
+@decorator
+def flush_pending_messages(function):
+    """Store the queued messages before running a query that depends on them"""
+    @preserve_signature(function)
+    def wrapper(*args, **kw):
+        MessageHistory()._flush_pending_messages()
+        return function(*args, **kw)
+    return wrapper
+
+
+@decorator
+def run_in_reader(function):
+    """Run a read-only query on the history reader threads once the queued messages are stored"""
+    @preserve_signature(function)
+    def wrapper(self, *args, **kw):
+        self._dispatch_read(function, self, *args, **kw)
+    return wrapper
 
 
 class TableVersions(object, metaclass=Singleton):
@@ -363,9 +687,13 @@ class TableVersions(object, metaclass=Singleton):
 
 
 class DownloadHistory(object, metaclass=Singleton):
-    __version__ = 1
+    __version__ = 2
     phone_number_re = re.compile(r'^(?P<number>(0|00|\+)[1-9]\d{7,14})@')
 
+    # Downloads advertised with a hash are linked to a single copy of their content, stored under its digest
+    objects_directory = 'downloads/.objects'
+    content_algorithms = {'sha1', 'sha224', 'sha256', 'sha384', 'sha512'}
+
     def __init__(self):
         db_file = ApplicationData.get('message_history.db')
         db_uri = f'sqlite:{db_file}'
@@ -388,37 +716,128 @@ class DownloadHistory(object, metaclass=Singleton):
             self._check_table_version()
 
     def _check_table_version(self):
-        pass
+        table = DownloadedFiles.sqlmeta.table
+        db_table_version = self.table_versions.version(table)
+        if self.__version__ != db_table_version:
+            if (db_table_version or 0) < 2:
+                for query in (f'alter table {table} add column content_key TEXT DEFAULT NULL',
+                              f'alter table {table} add column last_access TIMESTAMP DEFAULT NULL'):
+                    try:
+                        self.db.query(query)
+                    except dberrors.OperationalError:
+                        pass
+                try:
+                    self.db.query(f'create index if not exists {table}_content_key_idx on {table} (content_key)')
+                except dberrors.OperationalError as e:
+                    log.warning(f'Failed to create download history index: {e}')
+                    return
+            self.table_versions.set_version(table, self.__version__)
 
     @classmethod
-    @run_in_thread('db')
-    def add(cls, session):
+    def _remote_uri(cls, session):
         remote_uri = str(session.contact_uri.uri)
         match = cls.phone_number_re.match(remote_uri)
         if match:
             remote_uri = match.group('number')
+        return remote_uri
+
+    @classmethod
+    @run_in_thread('db')
+    def add(cls, session):
         try:
             DownloadedFiles(file_id=session.id,
                             account_id=str(session.account.id),
-                            remote_uri=remote_uri,
+                            remote_uri=cls._remote_uri(session),
                             filename=session.file_selector.name)
         except dberrors.DuplicateEntryError:
             pass
 
     @classmethod
     @run_in_thread('db')
-    def add_file(cls, session, file):
-        remote_uri = str(session.contact_uri.uri)
-        match = cls.phone_number_re.match(remote_uri)
-        if match:
-            remote_uri = match.group('number')
+    def add_file(cls, session, file, content_key=None):
+        last_access = datetime.now(timezone.utc).replace(tzinfo=None)
         try:
             DownloadedFiles(file_id=file.id,
                             account_id=str(session.account.id),
-                            remote_uri=remote_uri,
-                            filename=file.name)
+                            remote_uri=cls._remote_uri(session),
+                            filename=file.name,
+                            content_key=content_key,
+                            last_access=last_access)
         except dberrors.DuplicateEntryError:
+            # the file was opened again, which makes it the most recently used one
+            for entry in DownloadedFiles.selectBy(file_id=file.id, account_id=str(session.account.id), filename=file.name):
+                entry.set(last_access=last_access, content_key=content_key or entry.content_key)
+
+    @classmethod
+    def content_key(cls, hash):
+        """Return the key under which content advertised with hash is stored, None if the hash cannot be checked"""
+        if not hash:
+            return None
+        algorithm, separator, value = hash.partition(':')
+        algorithm = algorithm.strip().lower().replace('-', '')
+        if not separator or algorithm not in cls.content_algorithms:
+            return None
+        try:
+            digest = bytes.fromhex(value.replace(':', ''))
+        except ValueError:
+            try:
+                digest = base64.b64decode(value.strip(), validate=True)
+            except ValueError:
+                return None
+        if len(digest) != hashlib.new(algorithm).digest_size:
+            return None
+        return f'{algorithm}-{digest.hex()}'
+
+    def _object_path(self, key):
+        return os.path.join(ApplicationData.get(self.objects_directory), key)
+
+    @staticmethod
+    def _link(source, destination):
+        try:
+            os.link(source, destination)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError:
+            # file systems without hard links get a copy
+            shutil.copyfile(source, destination)
+
+    def link_cached_file(self, hash, filename):
+        """Create filename from the stored content advertised with hash, returns the content key or None if the content is not stored"""
+        key = self.content_key(hash)
+        if key is None:
+            return None
+        try:
+            self._link(self._object_path(key), filename)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning(f'Failed to use cached file for {filename}: {e}')
+            return None
+        return key
+
+    def store_cached_file(self, hash, filename):
+        """Add the downloaded filename to the stored content if it matches hash, returns the content key or None"""
+        key = self.content_key(hash)
+        if key is None:
+            return None
+        algorithm, digest = key.split('-', 1)
+        checksum = hashlib.new(algorithm)
+        try:
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    checksum.update(chunk)
+            if checksum.hexdigest() != digest:
+                # other conversations must not receive content its sender did not advertise
+                log.warning(f'== File {filename} does not match its advertised hash, it will not be shared')
+                return None
+            makedirs(ApplicationData.get(self.objects_directory))
+            self._link(filename, self._object_path(key))
+        except FileExistsError:
             pass
+        except OSError as e:
+            log.warning(f'Failed to add {filename} to the download cache: {e}')
+            return None
+        return key
 
     def get_decrypted_filename(self, file):
         try:
@@ -430,22 +849,53 @@ class DownloadHistory(object, metaclass=Singleton):
     def remove(self, id):
         log.debug(f'== Trying to remove download cache: {id}')
         result = DownloadedFiles.selectBy(file_id=id)
+        keys = set()
         for file in result:
             self.remove_cache_file(file)
             log.info(f'== Removing file entry: {file.file_id}')
+            keys.add(file.content_key)
             file.destroySelf()
+        self._remove_unreferenced_objects(keys)
+
+    def _remove_unreferenced_objects(self, keys):
+        keys = list(filter(None, keys))
+        if not keys:
+            return
+        table = DownloadedFiles.sqlmeta.table
+        try:
+            referenced = {row[0] for row in self.db.queryAll(f"select distinct content_key from {table} where content_key in ({', '.join(DownloadedFiles.sqlrepr(key) for key in keys)})")}
+        except dberrors.Error as e:
+            log.warning(f'Failed to look up cached files: {e}')
+            return
+        unreferenced = [key for key in keys if key not in referenced]
+        if unreferenced:
+            self.remove_cache_objects(unreferenced)
+
+    @run_in_thread('file-io')
+    def remove_cache_objects(self, keys):
+        for key in keys:
+            log.info(f'== Removing unreferenced file from cache: {key}')
+            unlink(self._object_path(key))
 
     @run_in_thread('file-io')
     def remove_cache_file(self, file):
-        filename = os.path.basename(file.filename)
+        self._remove_cache_file(file.file_id, file.filename)
+
+    @run_in_thread('file-io')
+    def remove_cache_files(self, files):
+        for file_id, filename in files:
+            self._remove_cache_file(file_id, filename)
+
+    def _remove_cache_file(self, file_id, filename):
+        filename = os.path.basename(filename)
         if filename.endswith('.asc'):
             filename = filename.rsplit('.', 1)[0]
-        cached_file = os.path.join(ApplicationData.get('downloads'), file.file_id, filename)
+        cached_file = os.path.join(ApplicationData.get('downloads'), file_id, filename)
         file_in_cache = os.path.exists(cached_file)
         if not file_in_cache:
-            #log.info(f'== Not removing file, not present in cache: {file.file_id} {cached_file}')
+            #log.info(f'== Not removing file, not present in cache: {file_id} {cached_file}')
             return
-        log.info(f'== Removing file from cache: {file.file_id} {cached_file}')
+        log.info(f'== Removing file from cache: {file_id} {cached_file}')
         unlink(cached_file)
         try:
             os.rmdir(os.path.dirname(cached_file))
@@ -455,38 +905,282 @@ class DownloadHistory(object, metaclass=Singleton):
     @run_in_thread('db')
     def remove_contact_files(self, account, contact):
         log.info(f'== Removing file entries and files from cache between {account.id} <-> {contact}')
-        result = DownloadedFiles.selectBy(remote_uri=contact, account_id=str(account.id))
-        for file in result:
-            self.remove_cache_file(file)
-            file.destroySelf()
+        table = DownloadedFiles.sqlmeta.table
+        condition = f'remote_uri = {DownloadedFiles.sqlrepr(contact)} and account_id = {DownloadedFiles.sqlrepr(str(account.id))}'
+        try:
+            files = self.db.queryAll(f'select file_id, filename, content_key from {table} where {condition}')
+            self.db.query(f'delete from {table} where {condition}')
+        except dberrors.Error as e:
+            log.warning(f'Failed to remove file entries between {account.id} <-> {contact}: {e}')
+            return
+        if files:
+            self.remove_cache_files([(file_id, filename) for file_id, filename, content_key in files])
+            self._remove_unreferenced_objects({content_key for file_id, filename, content_key in files})
 
     @run_in_thread('db')
-    def update(self, id, state):
-        messages = Message.selectBy(message_id=id)
-        for message in messages:
-            if message.direction == 'outgoing' and state == 'received':
+    def evict(self, protected=()):
+        """Remove the least recently used downloads until the cache fits its size budget, keeping the files of the protected (account_id, remote_uri) conversations"""
+        budget = BlinkSettings().message_history.download_cache_size * 1024 * 1024
+        if not budget:
+            return
+        try:
+            rows = self.db.queryAll(f'select file_id, filename, account_id, remote_uri, content_key, last_access from {DownloadedFiles.sqlmeta.table}')
+        except dberrors.Error as e:
+            log.warning(f'Failed to read the download history: {e}')
+            return
+        # Files with the same content are evicted together, they are the same file on disk
+        entries = {}
+        for file_id, filename, account_id, remote_uri, content_key, last_access in rows:
+            entry = entries.setdefault(content_key or (None, file_id), dict(files=[], last_access='', protected=False, content_key=content_key))
+            entry['files'].append((file_id, filename))
+            entry['last_access'] = max(entry['last_access'], str(last_access or ''))
+            entry['protected'] = entry['protected'] or (account_id, remote_uri) in protected
+        candidates = sorted((entry for entry in entries.values() if not entry['protected']), key=lambda entry: entry['last_access'])
+        self._evict_files(candidates, budget)
+
+    def _cache_paths(self, file_id, filename):
+        filename = os.path.basename(filename)
+        directory = os.path.join(ApplicationData.get('downloads'), file_id)
+        paths = [os.path.join(directory, filename)]
+        if filename.endswith('.asc'):
+            paths.append(os.path.join(directory, filename.rsplit('.', 1)[0]))
+        return paths
+
+    @staticmethod
+    def _disk_usage(paths, seen):
+        # hard links are counted once
+        size = 0
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
                 continue
+            if (info.st_dev, info.st_ino) not in seen:
+                seen.add((info.st_dev, info.st_ino))
+                size += info.st_size
+        return size
+
+    @run_in_thread('file-io')
+    def _evict_files(self, candidates, budget):
+        seen = set()
+        total = 0
+        for directory, subdirectories, filenames in os.walk(ApplicationData.get('downloads')):
+            total += self._disk_usage((os.path.join(directory, filename) for filename in filenames), seen)
+        if total <= budget:
+            return
+        log.info(f'== Download cache uses {total} bytes, evicting files to fit in {budget} bytes')
+        evicted = []
+        for entry in candidates:
+            if total <= budget:
+                break
+            paths = [path for file_id, filename in entry['files'] for path in self._cache_paths(file_id, filename)]
+            if entry['content_key']:
+                paths.append(self._object_path(entry['content_key']))
+            total -= self._disk_usage(paths, set())
+            for path in paths:
+                unlink(path)
+            for file_id, filename in entry['files']:
+                try:
+                    os.rmdir(os.path.join(ApplicationData.get('downloads'), file_id))
+                except OSError:
+                    pass
+                evicted.append(file_id)
+        log.info(f'== Evicted {len(evicted)} files from the download cache')
+        self._remove_entries(evicted)
+
+    @run_in_thread('db')
+    def _remove_entries(self, file_ids):
+        # the messages remain, their files are downloaded again when opened
+        table = DownloadedFiles.sqlmeta.table
+        try:
+            for index in range(0, len(file_ids), 500):
+                self.db.query(f"delete from {table} where file_id in ({', '.join(DownloadedFiles.sqlrepr(file_id) for file_id in file_ids[index:index + 500])})")
+        except dberrors.Error as e:
+            log.warning(f'Failed to remove evicted file entries: {e}')
+
+    def update(self, id, state):
+        MessageHistory().update(id, state)
 
-            if message.state != 'displayed' and message.state != state:
-                log.info(f'Update {message.direction} {id} {message.state} -> {state}')
-                message.state = state
+
+class CallHistory(object, metaclass=Singleton):
+    __version__ = 1
+
+    def __init__(self):
+        db_file = ApplicationData.get('message_history.db')
+        db_uri = f'sqlite:{db_file}'
+        self._initialize(db_uri)
+
+    @run_in_thread('db')
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        Call._connection = self.db
+        self.table_versions = TableVersions()
+
+        if not Call.tableExists():
+            try:
+                Call.createTable()
+            except Exception as e:
+                pass
+            else:
+                self.table_versions.set_version(Call.sqlmeta.table, self.__version__)
+
+    @staticmethod
+    def _fields(entry):
+        # Call times are stored as naive UTC
+        return dict(direction=entry.direction,
+                    uri=str(entry.uri),
+                    display_name=entry.name or '',
+                    account_id=str(entry.account_id),
+                    call_time=utc_timestamp(entry.call_time),
+                    duration=int(entry.duration.total_seconds()) if entry.duration else None,
+                    failed=entry.failed,
+                    reason=entry.reason or '',
+                    media=','.join(entry.media))
+
+    @run_in_thread('db')
+    def add(self, entry):
+        try:
+            Call(**self._fields(entry))
+        except dberrors.Error as e:
+            log.warning(f'Failed to store call with {entry.uri} to history: {e}')
+
+    @run_in_thread('db')
+    def migrate(self, entries, filename):
+        log.info(f'== Migrating {len(entries)} calls to call history')
+        transaction = self.db.transaction()
+        try:
+            for entry in entries:
+                Call(connection=transaction, **self._fields(entry))
+            transaction.commit(close=True)
+        except Exception as e:
+            transaction.rollback()
+            log.warning(f'Failed to migrate call history: {e}')
+        else:
+            os.replace(filename, filename + '.migrated')
+
+    @run_in_thread('db')
+    def get_recent(self, count=20):
+        try:
+            calls = list(Call.select().orderBy(['call_time', 'id']).reversed()[:count])
+        except Exception as e:
+            log.warning(f'Failed to load recent calls: {e}')
+            return
+        entries = [HistoryEntry.from_call(call) for call in reversed(calls)]
+        NotificationCenter().post_notification('BlinkCallHistoryRecentDidLoad', sender=self, data=NotificationData(entries=entries))
+
+    @run_in_thread('db')
+    def load(self, cursor=None, count=50, uri=None, account=None, text=None):
+        # Pages go back in time, cursor is the (call_time, id) of the oldest call of the previous page
+        conditions = []
+        if cursor is not None:
+            call_time, id = cursor
+            conditions.append(OR(Call.q.call_time < call_time, AND(Call.q.call_time == call_time, Call.q.id < id)))
+        if uri is not None:
+            conditions.append(Call.q.uri == uri)
+        if account is not None:
+            conditions.append(Call.q.account_id == str(account.id))
+        if text:
+            conditions.append(OR(Call.q.uri.contains(text), Call.q.display_name.contains(text)))
+        notification_center = NotificationCenter()
+        try:
+            calls = list(Call.select(AND(*conditions) if conditions else None).orderBy(['call_time', 'id']).reversed()[:count + 1])
+        except Exception as e:
+            notification_center.post_notification('BlinkCallHistoryLoadDidFail', sender=self, data=NotificationData(cursor=cursor, error=str(e)))
+            return
+        more = len(calls) > count
+        calls = calls[:count]
+        cursor = (calls[-1].call_time, calls[-1].id) if calls else None
+        entries = [HistoryEntry.from_call(call) for call in calls]
+        notification_center.post_notification('BlinkCallHistoryLoadDidSucceed', sender=self, data=NotificationData(entries=entries, cursor=cursor, more=more))
 
 
 @implementer(IObserver)
 class MessageHistory(object, metaclass=Singleton):
-    __version__ = 4
+    __version__ = 7
+    __search_version__ = 1
+    __conversations_version__ = 1
     phone_number_re = re.compile(r'^(?P<number>(0|00|\+)[1-9]\d{7,14})@')
+    search_term_re = re.compile(r'\w+', re.UNICODE)
+
+    __ignored_content_types__ = {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}
+
+    batch_size = 200
+    batch_interval = 0.5  # seconds
+    store_attempts = 10  # flushes a message or state change waits for a locked database before it is discarded
+
+    remove_chunk_size = 1000
+    compression_chunk_size = 500
+    retention_chunk_size = 500
+    retention_interval = 24 * 60 * 60  # seconds
+    retry_interval = 60  # seconds
+    retry_delay = 30  # seconds, doubled after every attempt
+    retry_max_delay = 6 * 60 * 60  # seconds
+    retry_burst = 5  # messages per account and pass
+    archive_batch_size = 1000
+    vacuum_chunk_size = 5000  # pages
+    vacuum_delay = 30  # seconds
+    auto_vacuum_marker = 'messages_auto_vacuum'  # recorded in the table versions once the vacuum mode was switched
+
+    # Writes are serialized on the 'db' thread, reads run on their own connections in WAL mode
+    writer_pragmas = ('auto_vacuum = incremental', 'journal_mode = wal', 'synchronous = normal', 'cache_size = -16000', 'mmap_size = 268435456', 'temp_store = memory')
+    reader_pragmas = ('query_only = 1', 'cache_size = -8000', 'mmap_size = 268435456', 'temp_store = memory')
+
+    read_pool = ThreadPool(name='history-readers', min_threads=1, max_threads=3)
+    read_pool.start()
+
+    # Added in version 5, partial indexes are only used by queries repeating their where clause
+    query_indexes = {'messages_conversation_idx': "(remote_uri, timestamp, message_id) where state != 'deleted'",
+                     'messages_pending_decryption_idx': "(remote_uri, timestamp, message_id) where decrypted = '3'",
+                     'messages_state_direction_account_idx': '(state, direction, account_id)',
+                     'messages_remote_time_idx': '(remote_uri, timestamp_us)'}
+
+    # Fills in timestamp_us for rows written before version 7, timestamps are stored as 'YYYY-MM-DD HH:MM:SS.ffffff'
+    epoch_expression = "cast(strftime('%s', timestamp) as integer) * 1000000 + cast(substr(timestamp || '000000', 21, 6) as integer)"
+
+    search_table = 'messages_fts'
+    # Only plain text bodies are indexed, encrypted payloads and keys are not searchable
+    search_filter = "typeof({0}.content) = 'text' and {0}.content_type like 'text/%' and {0}.content_type not like '%pgp%' and instr({0}.content, '-----BEGIN PGP') = 0"
+
+    # The conversations table summarizes the messages matching these filters, it is kept up to date by triggers
+    conversation_types_filter = "{0}.content_type not like '%pgp%' and {0}.content_type not like '%sylk-api%' and {0}.content_type != 'application/blink-call-history'"
+    conversation_filter = conversation_types_filter + " and {0}.state != 'deleted'"
+    conversation_unread = "({0}.direction = 'incoming' and {0}.state not in ('deleted', 'displayed'))"
+    conversation_name = "case when {0}.direction = 'incoming' and coalesce({0}.display_name, '') not in ('', {0}.remote_uri) then {0}.display_name else '' end"
+    conversation_preview = "case when typeof({0}.content) = 'text' and {0}.content_type like 'text/%' and instr({0}.content, '-----BEGIN PGP') = 0 then substr({0}.content, 1, 200) else '' end"
+
+    # Only bodies that are neither searchable nor previewed are compressed, the triggers never see compressed content
+    compression_level = 9
+    compression_filter = "typeof({{0}}.content) = 'text' and length({{0}}.content) >= {{1}} and not ({search_filter})".format(search_filter=search_filter)
 
     def __init__(self):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        notification_center.add_observer(self, name='SIPApplicationWillEnd')
+
+        self._reader = threading.local()
+        self._pending_messages = []
+        self._pending_states = []
+        self._state_attempts = 0
+        self._flush_timer = QTimer()
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(int(self.batch_interval * 1000))
+        self._flush_timer.timeout.connect(self._flush_pending_messages)
+        self._vacuum_timer = QTimer()
+        self._vacuum_timer.setSingleShot(True)
+        self._vacuum_timer.setInterval(self.vacuum_delay * 1000)
+        self._vacuum_timer.timeout.connect(self._vacuum)
+        self._retention_running = False
+        self._retention_timer = QTimer()
+        self._retention_timer.setInterval(self.retention_interval * 1000)
+        self._retention_timer.timeout.connect(self.apply_retention)
+        self._retention_timer.start()
 
         db_file = ApplicationData.get('message_history.db')
         db_uri = f'sqlite:{db_file}'
         makedirs(ApplicationData.directory)
         self._initialize(db_uri)
         self._retry_timer = QTimer()
-        self._retry_timer.setInterval(60 * 1000)  # a minute (in milliseconds)
+        self._retry_timer.setInterval(self.retry_interval * 1000)
         self._retry_timer.timeout.connect(self._retry_failed_messages)
         self._retry_timer.start()
 
@@ -496,12 +1190,199 @@ class MessageHistory(object, metaclass=Singleton):
         handler(notification)
 
     def _NH_NetworkConditionsDidChange(self, notification):
-        self._retry_failed_messages()
+        self._retry_failed_messages(due_only=False)
+
+    def _NH_SIPApplicationWillEnd(self, notification):
+        self._flush_timer.stop()
+        self._vacuum_timer.stop()
+        self._retention_timer.stop()
+        self._flush_pending_messages()
+
+    @run_in_gui_thread
+    def _schedule_flush(self):
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @run_in_gui_thread
+    def _schedule_vacuum(self):
+        self._vacuum_timer.start()
+
+    @run_in_thread('db')
+    def _vacuum(self):
+        try:
+            # Databases created before auto_vacuum was enabled need one full vacuum to switch to incremental mode.
+            # It is only attempted once, it blocks every write while it runs.
+            if self.table_versions.version(self.auto_vacuum_marker) is None:
+                self.table_versions.set_version(self.auto_vacuum_marker, 1)
+                if self.db.queryOne('pragma auto_vacuum')[0] != 2:
+                    log.info('== Enabling incremental vacuum for message history')
+                    self.db.query('pragma auto_vacuum = incremental')
+                    self.db.query('vacuum')
+                    return
+            free_pages = self.db.queryOne('pragma freelist_count')[0]
+        except dberrors.Error as e:
+            log.warning(f'Failed to vacuum message history: {e}')
+            return
+
+        # Each step of the pragma releases a single page, batching the steps in a transaction avoids one commit per page
+        log.debug(f'== Releasing {free_pages} free pages from message history')
+        while free_pages > 0:
+            transaction = self.db.transaction()
+            try:
+                for i in range(min(free_pages, self.vacuum_chunk_size)):
+                    transaction.query('pragma incremental_vacuum')
+                transaction.commit(close=True)
+            except dberrors.Error as e:
+                transaction.rollback()
+                log.warning(f'Failed to vacuum message history: {e}')
+                return
+            free_pages -= self.vacuum_chunk_size
+
+    def _remove_messages(self, condition, **data):
+        notification_center = NotificationCenter()
+        tables = [Message.sqlmeta.table, ArchivedMessage.sqlmeta.table] if self.archive else [Message.sqlmeta.table]
+        total = sum(self.db.queryOne(f'select count(*) from {table} where {condition}')[0] for table in tables)
+        removed = 0
+        # Short transactions keep the WAL small and let readers see the progress
+        for table in tables:
+            while removed < total:
+                count = self._remove_chunk(table, condition, self.remove_chunk_size)
+                if not count:
+                    break
+                removed += count
+                notification_center.post_notification('BlinkMessageHistoryRemoveDidProgress', data=NotificationData(removed=removed, total=total, **data))
+        notification_center.post_notification('BlinkMessageHistoryRemoveDidEnd', data=NotificationData(removed=removed, **data))
+        if removed:
+            self._schedule_vacuum()
+        return removed
+
+    def _remove_chunk(self, table, condition, limit):
+        transaction = self.db.transaction()
+        try:
+            transaction.query(f'delete from {table} where id in (select id from {table} where {condition} limit {limit})')
+            count = transaction.queryOne('select changes()')[0]
+            transaction.commit(close=True)
+        except dberrors.Error as e:
+            transaction.rollback()
+            log.warning(f'Failed to remove messages from history: {e}')
+            return 0
+        return count
+
+    def _queue_message(self, message):
+        self._pending_messages.append(message)
+        if len(self._pending_messages) >= self.batch_size:
+            self._flush_pending_messages()
+        else:
+            self._schedule_flush()
+
+    @run_in_thread('db')
+    def _flush_pending_messages(self):
+        # The state changes can refer to queued messages, they wait while some of those are queued again
+        if self._store_pending_messages():
+            self._store_pending_states()
+
+    def _store_pending_messages(self):
+        # Returns False when some messages found the database locked and were queued again
+        if not self._pending_messages:
+            return True
+
+        pending, self._pending_messages = self._pending_messages, []
+        stored, failed = self._store_messages(pending)
+        if failed:
+            self._pending_messages[:0] = failed
+            self._schedule_flush()
+        return not failed
+
+    def _insert_messages(self, pending):
+        # One transaction for all the messages, a duplicate is skipped by its own statement
+        stored = []
+        remote_uris = {item.fields['remote_uri'] for item in pending}
+        with self.store.transaction() as connection:
+            unread_before = self._unread_counts(remote_uris, connection=connection)
+            for item in pending:
+                message = self.store.insert(connection, item.fields)
+                if message is not None:
+                    stored.append((item, message))
+                elif item.replace_content:
+                    self.store.replace_content(connection, item.fields['message_id'], item.fields['content'])
+            unread_after = self._unread_counts(remote_uris, connection=connection)
+        return stored, unread_before, unread_after
+
+    def _store_messages(self, pending):
+        # Returns the stored messages and the ones to try again later
+        failed = []
+        try:
+            stored, unread_before, unread_after = self._insert_messages(pending)
+        except Exception as e:
+            # A single bad row must not cost the whole batch, the messages are stored one at a time instead
+            log.warning(f'Failed to store {len(pending)} messages to history, storing them one by one: {e}')
+            stored, unread_before, unread_after = [], {}, {}
+            for index, item in enumerate(pending):
+                try:
+                    item_stored, item_unread_before, item_unread_after = self._insert_messages([item])
+                except Exception as e:
+                    if database_is_busy(e) and item.attempts + 1 < self.store_attempts:
+                        # Another connection holds the lock, the rest of the batch is kept for the next flush
+                        log.warning(f'Failed to store {len(pending) - index} messages to history, will try again: {e}')
+                        for item in pending[index:]:
+                            item.attempts += 1
+                        failed = pending[index:]
+                        break
+                    # Errors that do not go away by themselves must not hold up the messages and states queued after it
+                    log.error(f"Failed to store message {item.fields.get('message_id')} to history, discarding it: {e}")
+                    continue
+                stored.extend(item_stored)
+                for remote_uri, count in item_unread_before.items():
+                    unread_before.setdefault(remote_uri, count)
+                unread_after.update(item_unread_after)
+
+        log.debug(f'== Stored {len(stored)} of {len(pending)} queued messages to history')
+
+        notification_center = NotificationCenter()
+        stored_messages = {}
+        for item, message in stored:
+            if item.kind == 'call':
+                notification_center.post_notification('BlinkMessageHistoryCallHistoryDidStore', sender=item.sender, data=NotificationData(message=message))
+                continue
+
+            if item.kind == 'session':
+                if message.direction == 'outgoing':
+                    log.info(f"Message {message.message_id} to {message.remote_uri} stored")
+                else:
+                    log.info(f"Message {message.message_id} from {message.remote_uri} stored")
+
+            if item.notify:
+                stored_messages.setdefault(item.sender, []).append(NotificationData(remote_uri=message.remote_uri, state=item.fields.get('state'), direction=message.direction))
+
+        for account, messages in stored_messages.items():
+            notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=account, data=NotificationData(messages=messages))
+
+        self._post_unread_changes(unread_before, unread_after)
+
+        if stored and BlinkSettings().message_history.compression:
+            self._compress_messages(f"id in ({', '.join(str(message.id) for item, message in stored)})")
+        return stored, failed
+
+    def _unread_counts(self, remote_uris, connection=None):
+        if not remote_uris:
+            return {}
+        if connection is None:
+            with self.store.connection() as connection:
+                return self.store.unread_counts(connection, self._get_enabled_account_ids(), list(remote_uris))
+        return self.store.unread_counts(connection, self._get_enabled_account_ids(), list(remote_uris))
+
+    def _post_unread_changes(self, before, after):
+        changes = {uri: after.get(uri, 0) - before.get(uri, 0) for uri in before.keys() | after.keys()}
+        changes = {uri: delta for uri, delta in changes.items() if delta}
+        if changes:
+            NotificationCenter().post_notification('BlinkMessageHistoryUnreadMessagesDidChange', data=NotificationData(changes=changes))
 
     @run_in_thread('db')
     def _initialize(self, db_uri):
         self.db = connectionForURI(db_uri)
+        self._apply_pragmas(self.writer_pragmas)
         Message._connection = self.db
+        self.store = MessageStore(self.db)
         self.table_versions = TableVersions()
         if not Message.tableExists():
             try:
@@ -509,9 +1390,226 @@ class MessageHistory(object, metaclass=Singleton):
             except Exception as e:
                 pass
             else:
+                self._create_query_indexes()
                 self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
         else:
             self._check_table_version()
+        self._initialize_indexes()
+        self._initialize_search_index()
+        self._initialize_conversations()
+        self._initialize_archive()
+
+    def _apply_pragmas(self, pragmas):
+        # SQLObject keeps one SQLite connection per thread, so this configures the connection of the calling thread
+        for pragma in pragmas:
+            try:
+                self.db.query(f'pragma {pragma}')
+            except dberrors.Error as e:
+                log.warning(f'Failed to set message history pragma {pragma}: {e}')
+
+    def _dispatch_read(self, function, *args, **kw):
+        # Reads go straight to the reader threads, only while messages or state changes are queued
+        # they wait for the writer to store those, so that the results include them
+        barrier = None
+        if self._pending_messages or self._pending_states:
+            barrier = threading.Event()
+            self._flush_for_read(barrier)
+        self.read_pool.run(self._run_read, barrier, function, *args, **kw)
+
+    @run_in_thread('db')
+    def _flush_for_read(self, barrier):
+        try:
+            self._flush_pending_messages()
+        finally:
+            barrier.set()
+
+    def _run_read(self, barrier, function, *args, **kw):
+        if barrier is not None:
+            barrier.wait()
+        if not getattr(self._reader, 'initialized', False):
+            if self.archive:
+                try:
+                    self._attach_archive()
+                except dberrors.Error as e:
+                    log.warning(f'Failed to attach message history archive: {e}')
+            self._apply_pragmas(self.reader_pragmas)
+            self._reader.initialized = True
+        function(*args, **kw)
+
+    def _initialize_indexes(self):
+        # Indexes added to the Message model after the table was first created
+        query = f'create index if not exists {Message.sqlmeta.table}_remote_timestamp_idx on {Message.sqlmeta.table} (remote_uri, timestamp)'
+        try:
+            self.db.query(query)
+        except dberrors.OperationalError as e:
+            log.warning(f'Failed to create message history index: {e}')
+
+    def _replace_triggers(self, triggers):
+        # Triggers are recreated on every start, so they always match the filters defined here
+        transaction = self.db.transaction()
+        try:
+            for name, definition in triggers:
+                transaction.query(f'drop trigger if exists {name}')
+                transaction.query(f'create trigger {name} {definition}')
+        except dberrors.Error:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit(close=True)
+
+    def _search_index_definition(self, schema='main'):
+        # Both the index and its triggers refer to the messages table of the same schema
+        query = f"""create virtual table if not exists {schema}.{self.search_table} using fts5(content, content='{Message.sqlmeta.table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"""
+        triggers = [(f"{schema}.{self.search_table}_insert", f"""after insert on {Message.sqlmeta.table} when {self.search_filter.format('new')} begin
+                        insert into {self.search_table}(rowid, content) values (new.id, new.content);
+                    end"""),
+                    (f"{schema}.{self.search_table}_delete", f"""after delete on {Message.sqlmeta.table} when {self.search_filter.format('old')} begin
+                        insert into {self.search_table}({self.search_table}, rowid, content) values ('delete', old.id, old.content);
+                    end"""),
+                    (f"{schema}.{self.search_table}_update", f"""after update of content, content_type on {Message.sqlmeta.table} begin
+                        insert into {self.search_table}({self.search_table}, rowid, content) select 'delete', old.id, old.content where {self.search_filter.format('old')};
+                        insert into {self.search_table}(rowid, content) select new.id, new.content where {self.search_filter.format('new')};
+                    end""")]
+        return query, triggers
+
+    def _initialize_search_index(self):
+        query, triggers = self._search_index_definition()
+        try:
+            self.db.query(query)
+            self._replace_triggers(triggers)
+        except dberrors.OperationalError as e:
+            log.warning(f'Message search index is not available: {e}')
+            self.search_index = False
+            return
+
+        self.search_index = True
+        if self.table_versions.version(self.search_table) != self.__search_version__:
+            log.info('== Building message search index')
+            query = f"""insert into {self.search_table}(rowid, content)
+                select id, content from {Message.sqlmeta.table} as messages where {self.search_filter.format('messages')}"""
+            try:
+                self.db.query(f"insert into {self.search_table}({self.search_table}) values ('delete-all')")
+                self.db.query(query)
+            except dberrors.OperationalError as e:
+                log.warning(f'Failed to build message search index: {e}')
+            else:
+                self.table_versions.set_version(self.search_table, self.__search_version__)
+
+    def _rebuild_conversations_query(self, condition):
+        table = Conversation.sqlmeta.table
+        return f"""insert into {table} (account_id, remote_uri, display_name, last_timestamp, unread, preview)
+            select m.account_id, m.remote_uri,
+                   coalesce((select i.display_name from {Message.sqlmeta.table} as i where i.remote_uri = m.remote_uri and i.account_id = m.account_id and {self.conversation_name.format('i')} != '' order by i.id limit 1), ''),
+                   max(m.timestamp), sum({self.conversation_unread.format('m')}), {self.conversation_preview.format('m')}
+            from {Message.sqlmeta.table} as m where {self.conversation_filter.format('m')} and {condition}
+            group by m.account_id, m.remote_uri"""
+
+    def _initialize_conversations(self):
+        table = Conversation.sqlmeta.table
+        messages = Message.sqlmeta.table
+
+        # Adds a message to its conversation, creating the conversation if needed
+        def add(row):
+            return f"""insert into {table} (account_id, remote_uri, display_name, last_timestamp, unread, preview)
+                values ({row}.account_id, {row}.remote_uri, {self.conversation_name.format(row)}, {row}.timestamp, {self.conversation_unread.format(row)}, {self.conversation_preview.format(row)})
+                on conflict (account_id, remote_uri) do update set
+                    display_name = case when {table}.display_name = '' then excluded.display_name else {table}.display_name end,
+                    preview = case when excluded.last_timestamp >= {table}.last_timestamp then excluded.preview else {table}.preview end,
+                    last_timestamp = max({table}.last_timestamp, excluded.last_timestamp),
+                    unread = {table}.unread + excluded.unread;"""
+
+        # Removes a message from its conversation, the conversation is only rebuilt when its last message goes away
+        def remove(row):
+            same_conversation = f'account_id = {row}.account_id and remote_uri = {row}.remote_uri'
+            return f"""update {table} set unread = unread - {self.conversation_unread.format(row)} where {same_conversation} and {row}.timestamp < last_timestamp;
+                delete from {table} where {same_conversation} and {row}.timestamp >= last_timestamp;
+                {self._rebuild_conversations_query(f'm.account_id = {row}.account_id and m.remote_uri = {row}.remote_uri and not exists (select 1 from {table} where {same_conversation})')};"""
+
+        triggers = [(f"{table}_insert", f"""after insert on {messages} when {self.conversation_filter.format('new')} begin
+                        {add('new')}
+                    end"""),
+                    (f"{table}_delete", f"""after delete on {messages} when {self.conversation_filter.format('old')} begin
+                        {remove('old')}
+                    end"""),
+                    (f"{table}_update_state", f"""after update of state on {messages}
+                    when {self.conversation_types_filter.format('new')} and old.state != 'deleted' and new.state != 'deleted' and {self.conversation_unread.format('old')} != {self.conversation_unread.format('new')} begin
+                        update {table} set unread = unread + {self.conversation_unread.format('new')} - {self.conversation_unread.format('old')} where account_id = new.account_id and remote_uri = new.remote_uri;
+                    end"""),
+                    (f"{table}_update_deleted", f"""after update of state on {messages}
+                    when {self.conversation_types_filter.format('old')} and old.state != 'deleted' and new.state = 'deleted' begin
+                        {remove('old')}
+                    end"""),
+                    (f"{table}_update_restored", f"""after update of state on {messages}
+                    when {self.conversation_filter.format('new')} and old.state = 'deleted' begin
+                        {add('new')}
+                    end"""),
+                    (f"{table}_update_content", f"""after update of content on {messages} when {self.conversation_filter.format('new')} begin
+                        update {table} set preview = {self.conversation_preview.format('new')} where account_id = new.account_id and remote_uri = new.remote_uri and last_timestamp = new.timestamp;
+                    end""")]
+
+        Conversation._connection = self.db
+        try:
+            Conversation.createTable(ifNotExists=True)
+            self._replace_triggers(triggers)
+        except dberrors.Error as e:
+            log.warning(f'Failed to initialize conversations table: {e}')
+            return
+
+        if self.table_versions.version(table) != self.__conversations_version__:
+            log.info('== Building conversations table')
+            transaction = self.db.transaction()
+            try:
+                transaction.query(f'delete from {table}')
+                transaction.query(self._rebuild_conversations_query('1'))
+                transaction.commit(close=True)
+            except dberrors.Error as e:
+                transaction.rollback()
+                log.warning(f'Failed to build conversations table: {e}')
+            else:
+                self.table_versions.set_version(table, self.__conversations_version__)
+
+    def _attach_archive(self):
+        self.db.query(f"attach database {Message.sqlrepr(ApplicationData.get('message_history_archive.db'))} as archive")
+
+    def _initialize_archive(self):
+        # Messages moved out by the retention policies are kept in a separate database, attached to every connection
+        table = Message.sqlmeta.table
+        ArchivedMessage._connection = self.db
+        try:
+            self._attach_archive()
+            self.db.query('pragma archive.auto_vacuum = incremental')
+            self.db.query('pragma archive.journal_mode = wal')
+            if not self.db.queryOne(f"select count(*) from archive.sqlite_master where type = 'table' and name = '{table}'")[0]:
+                # the archive starts with the layout the messages table has at that time
+                definition = self.db.queryOne(f"select sql from main.sqlite_master where type = 'table' and name = '{table}'")[0]
+                self.db.query(re.sub(rf'^create table "?{table}"?', f'create table archive.{table}', definition, flags=re.IGNORECASE))
+            # columns added to the messages table by later versions
+            archived_columns = {row[1] for row in self.db.queryAll(f'pragma archive.table_info({table})')}
+            for position, name, type, notnull, default, primary_key in self.db.queryAll(f'pragma main.table_info({table})'):
+                if name not in archived_columns:
+                    self.db.query(f'alter table archive.{table} add column {name} {type}' + (f' DEFAULT {default}' if default is not None else ''))
+            if 'timestamp_us' not in archived_columns:
+                self._fill_epoch_timestamps('archive')
+            self.db.query(f'create unique index if not exists archive.{table}_unq_idx on {table} (message_id, account_id, remote_uri)')
+            self.db.query(f'create index if not exists archive.{table}_conversation_idx on {table} (remote_uri, timestamp, message_id)')
+            self.db.query(f'create index if not exists archive.{table}_account_idx on {table} (account_id)')
+            self.db.query(f'create index if not exists archive.{table}_remote_time_idx on {table} (remote_uri, timestamp_us)')
+            if self.search_index:
+                query, triggers = self._search_index_definition('archive')
+                self.db.query(query)
+                self._replace_triggers(triggers)
+        except dberrors.Error as e:
+            log.warning(f'Message history archive is not available: {e}')
+            self.archive = False
+        else:
+            self.archive = True
+
+    def _search_expression(self, text):
+        terms = self.search_term_re.findall(text)
+        if not terms:
+            return None
+        # every term must match, the last one may be incomplete while the user is typing
+        return ' '.join(f'"{term}"' for term in terms) + '*'
 
     def _check_table_version(self):
         db_table_version = self.table_versions.version(Message.sqlmeta.table)
@@ -560,30 +1658,84 @@ class MessageHistory(object, metaclass=Singleton):
 
                 self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
 
+            if (db_table_version or 0) < 6:
+                for query in (f'alter table {Message.sqlmeta.table} add column attempts INT DEFAULT 0',
+                              f'alter table {Message.sqlmeta.table} add column next_attempt TIMESTAMP DEFAULT NULL'):
+                    try:
+                        self.db.query(query)
+                    except dberrors.OperationalError:
+                        pass
+
+            if (db_table_version or 0) < 7:
+                try:
+                    self.db.query(f'alter table {Message.sqlmeta.table} add column timestamp_us INT DEFAULT NULL')
+                except dberrors.OperationalError:
+                    pass
+                self._fill_epoch_timestamps('main')
+
+            # Every upgrade ensures all the query indexes exist, later versions add their own to the list
+            if self._create_query_indexes():
+                self.table_versions.set_version(Message.sqlmeta.table, self.__version__)
+
+    def _fill_epoch_timestamps(self, schema):
+        log.info(f'== Adding epoch timestamps to {schema} message history')
+        try:
+            self.db.query(f'update {schema}.{Message.sqlmeta.table} set timestamp_us = {self.epoch_expression} where timestamp_us is null')
+        except dberrors.Error as e:
+            log.warning(f'Failed to add epoch timestamps to message history: {e}')
+
+    def _create_query_indexes(self):
+        log.info('== Creating message history query indexes')
+        for name, definition in self.query_indexes.items():
+            try:
+                self.db.query(f'create index if not exists {name} on {Message.sqlmeta.table} {definition}')
+            except dberrors.OperationalError as e:
+                log.warning(f'Failed to create message history index {name}: {e}')
+                return False
+        return True
+
+    def _get_enabled_account_ids(self):
+        return [account.id for account in AccountManager().iter_accounts() if account.enabled]
+
     def _get_enabled_account_filter(self, prefix=None):
-        account_manager = AccountManager()
-        enabled_accounts = [account.id for account in account_manager.iter_accounts() if account.enabled]
+        enabled_accounts = self._get_enabled_account_ids()
         table = f"{prefix}.account_id" if prefix else "account_id"
 
         return f"{table} IN ({','.join([repr(account) for account in enabled_accounts])})"
 
     @run_in_thread('db')
-    def _retry_failed_messages(self):
+    @flush_pending_messages
+    def _retry_failed_messages(self, due_only=True):
         if host.default_ip is None:
             return
 
-        messages = Message.selectBy(state='failed-local')
-        if len(list(messages)) > 0:
-            log.debug(f"==  {len(list(messages))} failed local messages from history")
-            NotificationCenter().post_notification('BlinkMessageHistoryFailedLocalFound', data=NotificationData(messages=list(messages)))
+        # Only the oldest few messages of every account are resent in one pass, the others wait for the next passes.
+        # After a network change the backoff is ignored, as the earlier failures were most likely caused by the network.
+        table = Message.sqlmeta.table
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        due = f'(next_attempt is null or next_attempt <= {Message.sqlrepr(now)})' if due_only else '1'
+        query = f"""select id from (select id, row_number() over (partition by account_id order by timestamp, id) as position
+                   from {table} where state = 'failed-local' and direction = 'outgoing' and {due}) where position <= {self.retry_burst}"""
+        try:
+            ids = [row[0] for row in self.db.queryAll(query)]
+            messages = list(Message.select(IN(Message.q.id, ids)).orderBy(['timestamp', 'id'])) if ids else []
+        except dberrors.Error as e:
+            log.warning(f'Failed to load failed local messages from history: {e}')
+            return
+        if not messages:
+            return
+
+        # Equal jitter keeps half of the exponential delay and randomizes the other half, so resends do not line up
+        for message in messages:
+            delay = min(self.retry_delay * 2 ** message.attempts, self.retry_max_delay)
+            message.set(attempts=message.attempts + 1, next_attempt=now + timedelta(seconds=delay / 2 + random.uniform(0, delay / 2)))
+
+        log.debug(f"== Resending {len(messages)} failed local messages from history")
+        NotificationCenter().post_notification('BlinkMessageHistoryFailedLocalFound', data=NotificationData(messages=messages))
 
-    @classmethod
     @run_in_thread('db')
-    def add_call_history_entry(cls, entry, session):
-        timestamp_native = entry.call_time
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - entry.call_time.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
+    def add_call_history_entry(self, entry, session):
+        timestamp = utc_timestamp(entry.call_time)
         media = "audio"
 
         if not session.streams and not session.proposed_streams:
@@ -607,34 +1759,29 @@ class MessageHistory(object, metaclass=Singleton):
                 result = """ (%dh%02d'%02d")""" % (seconds / 3600, (seconds % 3600) / 60, seconds % 60)
             else:
                 result = """ (%d'%02d")""" % (seconds / 60, seconds % 60)
-        try:
-            message = Message(remote_uri=entry.uri,
-                              display_name=entry.name,
-                              uri=uri,
-                              content=str([result, entry.reason.title() if entry.reason else '', media]),
-                              content_type='application/blink-call-history',
-                              message_id=str(uuid.uuid4()),
-                              account_id=str(entry.account_id),
-                              direction=entry.direction,
-                              timestamp=timestamp,
-                              decrypted='0',
-                              decryption_error='',
-                              disposition='',
-                              state='displayed')
-        except dberrors.DuplicateEntryError:
-            pass
-        else:
-            NotificationCenter().post_notification('BlinkMessageHistoryCallHistoryDidStore', sender=session, data=NotificationData(message=message))
+        fields = dict(remote_uri=entry.uri,
+                      display_name=entry.name,
+                      uri=uri,
+                      content=str([result, entry.reason.title() if entry.reason else '', media]),
+                      content_type='application/blink-call-history',
+                      message_id=str(uuid.uuid4()),
+                      account_id=str(entry.account_id),
+                      direction=entry.direction,
+                      timestamp=timestamp,
+                      decrypted='0',
+                      decryption_error='',
+                      disposition='',
+                      state='displayed')
+        self._queue_message(PendingMessage(fields, session, 'call'))
 
-    @classmethod
     @run_in_thread('db')
-    def add_from_server_history(cls, account, remote_uri, message, state=None, encryption=None):
+    def add_from_server_history(self, account, remote_uri, message, state=None, encryption=None):
         if message.content.startswith('?OTRv'):
             return
 
         log.info(f"== Adding {message.direction} history message to storage: {message.id} {state} {remote_uri}")
 
-        match = cls.phone_number_re.match(remote_uri)
+        match = self.phone_number_re.match(remote_uri)
         if match:
             remote_uri = match.group('number')
 
@@ -648,10 +1795,7 @@ class MessageHistory(object, metaclass=Singleton):
             else:
                 display_name = contact.name
 
-        timestamp_native = message.timestamp
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - message.timestamp.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
+        timestamp = utc_timestamp(message.timestamp)
 
         optional_fields = {}
         if state is not None:
@@ -664,30 +1808,23 @@ class MessageHistory(object, metaclass=Singleton):
         if not uri.startswith(('sip:', 'sips:')):
             uri = f'sip:{uri}'
 
-        try:
-            Message(remote_uri=remote_uri,
-                    display_name=display_name,
-                    uri=uri,
-                    content=message.content,
-                    content_type=message.content_type,
-                    message_id=message.id,
-                    account_id=str(account.id),
-                    direction=message.direction,
-                    timestamp=timestamp,
-                    decrypted='0',
-                    decryption_error='',
-                    disposition=str(message.disposition),
-                    **optional_fields)
-        except dberrors.DuplicateEntryError:
-            pass
-        else:
-            if message.content_type not in {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=account, data=NotificationData(remote_uri=remote_uri, state=state, direction=message.direction))
+        fields = dict(remote_uri=remote_uri,
+                      display_name=display_name,
+                      uri=uri,
+                      content=message.content,
+                      content_type=message.content_type,
+                      message_id=message.id,
+                      account_id=str(account.id),
+                      direction=message.direction,
+                      timestamp=timestamp,
+                      decrypted='0',
+                      decryption_error='',
+                      disposition=str(message.disposition),
+                      **optional_fields)
+        self._queue_message(PendingMessage(fields, account, 'server', notify=message.content_type not in self.__ignored_content_types__))
 
-    @classmethod
     @run_in_thread('db')
-    def add_from_session(cls, session, message, direction, state=None):
+    def add_from_session(self, session, message, direction, state=None):
         if message.content.startswith('?OTRv'):
             return
 
@@ -701,7 +1838,7 @@ class MessageHistory(object, metaclass=Singleton):
             domain = domain.decode() if isinstance(domain, bytes) else domain
 
             remote_uri = '%s@%s' % (user, domain)
-            match = cls.phone_number_re.match(remote_uri)
+            match = self.phone_number_re.match(remote_uri)
             if match:
                 remote_uri = match.group('number')
 
@@ -715,10 +1852,7 @@ class MessageHistory(object, metaclass=Singleton):
             else:
                 display_name = contact.name if contact.name != remote_uri else message.sender.display_name
 
-        timestamp_native = message.timestamp
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - message.timestamp.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
+        timestamp = utc_timestamp(message.timestamp)
 
         optional_fields = {}
         if state is not None:
@@ -736,39 +1870,36 @@ class MessageHistory(object, metaclass=Singleton):
             message_info = session.info.streams.messages
             if message_info.encryption is not None and message.is_secure:
                 optional_fields['encryption_type'] = str([f'{message_info.encryption}'])
-        try:
-            Message(remote_uri=remote_uri,
-                    display_name=display_name,
-                    uri=str(message.sender.uri),
-                    content=message.content,
-                    content_type=message.content_type,
-                    message_id=message.id,
-                    account_id=str(session.account.id),
-                    direction=direction,
-                    timestamp=timestamp,
-                    decrypted='0',
-                    decryption_error='',
-                    disposition=str(message.disposition),
-                    **optional_fields)
-        except dberrors.DuplicateEntryError:
-            try:
-                dbmessage = Message.selectBy(message_id=message.id)[0]
-            except IndexError:
-                pass
-            else:
-                if message.content != dbmessage.content:
-                    dbmessage.content = message.content
-        else:
-            if direction == 'outgoing':
-                log.info(f"Message {message.id} to {remote_uri} stored")
-            else:
-                log.info(f"Message {message.id} from {remote_uri} stored")
+        fields = dict(remote_uri=remote_uri,
+                      display_name=display_name,
+                      uri=str(message.sender.uri),
+                      content=message.content,
+                      content_type=message.content_type,
+                      message_id=message.id,
+                      account_id=str(session.account.id),
+                      direction=direction,
+                      timestamp=timestamp,
+                      decrypted='0',
+                      decryption_error='',
+                      disposition=str(message.disposition),
+                      **optional_fields)
+        self._queue_message(PendingMessage(fields, session.account, 'session', notify=message.content_type not in self.__ignored_content_types__, replace_content=True))
 
-            if message.content_type not in {IsComposingDocument.content_type, IMDNDocument.content_type, 'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove'}:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('BlinkMessageHistoryMessageDidStore', sender=session.account, data=NotificationData(remote_uri=remote_uri, state=state, direction=direction))
+    @run_in_thread('db')
+    def save_synchronization_checkpoint(self, account, message_id):
+        if message_id is None or account.sms.history_synchronization_id == message_id:
+            return
+        # The checkpoint only moves once the messages of its batch are stored, otherwise the next synchronization
+        # would resume after them. A later checkpoint covers this batch once the messages queued again are stored.
+        if not self._store_pending_messages():
+            log.warning(f'History synchronization checkpoint of {account.id} not saved, the messages before it are not stored yet')
+            return
+        self._store_pending_states()
+        account.sms.history_synchronization_id = message_id
+        account.save()
 
     @run_in_thread('db')
+    @flush_pending_messages
     def update_message(self, notification):
         message = notification.data
 
@@ -778,32 +1909,78 @@ class MessageHistory(object, metaclass=Singleton):
 
     @run_in_thread('db')
     def update(self, id, state):
-        messages = Message.selectBy(message_id=id)
-        for message in messages:
-            if message.direction == 'outgoing' and state == 'received':
-                continue
+        # State changes come in bursts, they are queued and applied together after the queued messages are stored
+        self._pending_states.append((id, state))
+        if len(self._pending_states) >= self.batch_size:
+            self._flush_pending_messages()
+        else:
+            self._schedule_flush()
 
-            if (state == 'deleted' or message.state != 'displayed') and message.state != state:
-                if message.direction == 'outgoing':
-                    log.info(f'Message {id} to {message.remote_uri} state changed {message.state} -> {state}')
-                else:
-                    log.info(f'Message {id} from {message.remote_uri} state changed {message.state} -> {state}')
-                message.state = state
+    @run_in_thread('db')
+    @flush_pending_messages
+    def bulk_update_states(self, updates):
+        self._apply_states(list(updates))
+
+    def _store_pending_states(self):
+        if self._pending_states:
+            pending, self._pending_states = self._pending_states, []
+            if self._apply_states(pending):
+                self._state_attempts = 0
+            elif self._state_attempts + 1 < self.store_attempts:
+                self._state_attempts += 1
+                self._pending_states[:0] = pending
+                self._schedule_flush()
+            else:
+                log.error(f'Failed to update the state of {len(pending)} messages, discarding the changes')
+                self._state_attempts = 0
+
+    def _apply_states(self, updates):
+        # Returns False when the database was locked and the updates should be applied later
+        if not updates:
+            return True
+        try:
+            with self.store.transaction() as connection:
+                remote_uris = self.store.incoming_remote_uris(connection, {id for (id, state) in updates})
+                unread_before = self._unread_counts(remote_uris, connection=connection)
+                changed = self.store.update_states(connection, updates)
+                unread_after = self._unread_counts(remote_uris, connection=connection)
+        except sqlite3.Error as e:
+            if database_is_busy(e):
+                log.warning(f'Failed to update the state of {len(updates)} messages, will try again: {e}')
+                return False
+            log.warning(f'Failed to update the state of {len(updates)} messages: {e}')
+            return True
+        log.debug(f'== Applied {changed} of {len(updates)} message state changes')
+        self._post_unread_changes(unread_before, unread_after)
+        return True
+
+    @run_in_thread('db')
+    def update_decrypted_content(self, message):
+        # Messages loaded from history are records, the decrypted content they receive is only kept once it is written back
+        schemas = ('main', 'archive') if self.archive else ('main',)
+        try:
+            with self.store.transaction() as connection:
+                self.store.update_content(connection, message.message_id, message.account_id, message.remote_uri, message.content, schemas=schemas)
+        except sqlite3.Error as e:
+            log.warning(f'Failed to store decrypted message {message.message_id}: {e}')
 
     @run_in_thread('db')
+    @flush_pending_messages
     def update_displayed_for_uri(self, remote_uri):
         query = f"""update messages set state = 'displayed' where direction = 'incoming'
         and remote_uri = {Message.sqlrepr(remote_uri)} and state != 'displayed'
         """
+        unread_before = self._unread_counts({remote_uri})
         try:
             result = self.db.queryAll(query)
         except Exception as e:
             pass
         else:
-            pass
+            self._post_unread_changes(unread_before, {})
             # log.info('Conversation with %s read saved to history' % remote_uri)
 
     @run_in_thread('db')
+    @flush_pending_messages
     def reset_decryption(self, account):
         query = f"""
             update messages set decrypted = '3', decryption_error = ''
@@ -818,6 +1995,7 @@ class MessageHistory(object, metaclass=Singleton):
             notification_center.post_notification('BlinkMessageHistoryMustReload', data=NotificationData(account=account))
 
     @run_in_thread('db')
+    @flush_pending_messages
     def update_encryption(self, notification, decrypted=None):
         message = notification.data.message
         session = notification.sender
@@ -846,58 +2024,68 @@ class MessageHistory(object, metaclass=Singleton):
                     if not decrypted:
                         db_message.decryption_error = notification.data.error
 
-    @run_in_thread('db')
+    @run_in_reader
     def load(self, uri, session, entries=100):
         notification_center = NotificationCenter()
         remote_uri = '%s@local' % session.remote_instance_id if session.remote_instance_id else uri
         try:
-            result = Message.select(AND(Message.q.remote_uri == remote_uri, Message.q.state != 'deleted')).orderBy('timestamp')[-entries:]
+            messages = self._load_messages(remote_uri, entries)
         except Exception as e:
             notification_center.post_notification('BlinkMessageHistoryLoadDidFail', sender=session, data=NotificationData(uri=uri))
             return
-        log.debug(f"== Loaded {len(list(result))} messages for {remote_uri} from history")
-        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=list(result), uri=uri))
+        log.debug(f"== Loaded {len(messages)} messages for {remote_uri} from history")
+        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=messages, uri=uri, more=len(messages) == entries))
 
-    @run_in_thread('db')
+    @run_in_reader
+    def load_before(self, remote_uri, timestamp, message_id, page_size=100, session=None):
+        notification_center = NotificationCenter()
+        uri = remote_uri
+        if session is not None and session.remote_instance_id:
+            remote_uri = '%s@local' % session.remote_instance_id
+        try:
+            messages = self._load_messages(remote_uri, page_size, before=(timestamp, message_id))
+        except Exception as e:
+            notification_center.post_notification('BlinkMessageHistoryLoadBeforeDidFail', sender=session, data=NotificationData(uri=uri))
+            return
+        log.debug(f"== Loaded {len(messages)} older messages for {remote_uri} from history")
+        notification_center.post_notification('BlinkMessageHistoryLoadBeforeDidSucceed', sender=session, data=NotificationData(messages=messages, uri=uri, more=len(messages) == page_size))
+
+    def _load_messages(self, remote_uri, count, before=None):
+        with self.store.connection() as connection:
+            messages = self.store.load(connection, remote_uri, count, before=before)
+            # Archived messages are older than the ones left in the messages table, they only complete a short page
+            if self.archive and len(messages) < count:
+                before = (messages[0].timestamp, messages[0].message_id) if messages else before
+                messages = self.store.load(connection, remote_uri, count - len(messages), before=before, schema='archive') + messages
+        return messages
+
+    @run_in_reader
     def reload_pending_encrypted(self, uri, session, entries=100):
         notification_center = NotificationCenter()
         remote_uri = '%s@local' % session.remote_instance_id if session.remote_instance_id else uri
         try:
-            result = Message.select(AND(Message.q.remote_uri == remote_uri, Message.q.state != 'deleted', Message.q.decrypted == '3')).orderBy('timestamp')[-entries:]
+            with self.store.connection() as connection:
+                messages = self.store.load(connection, remote_uri, entries, pending_decryption=True)
         except Exception as e:
             return
-        log.debug(f"== ReLoaded {len(list(result))} messages for {remote_uri} from history")
-        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=list(result), uri=uri))
+        log.debug(f"== ReLoaded {len(messages)} messages for {remote_uri} from history")
+        notification_center.post_notification('BlinkMessageHistoryLoadDidSucceed', sender=session, data=NotificationData(messages=messages, uri=uri))
 
-    @run_in_thread('db')
+    @run_in_reader
     def get_last_contacts(self, number=25, unread=False):
         log.info(f'== Getting last {number} contacts with messages unread={unread}')
 
+        # the display name is taken from the most recent conversation when the contact was used from several accounts
         if unread:
             query = f"""
-                select im.display_name, am.remote_uri, max(am.timestamp) from messages as am
-                left join (select display_name, remote_uri from messages where direction="incoming" group by remote_uri) as im
-                on am.remote_uri = im.remote_uri
-                where
-                am.content_type not like "%pgp%"
-                and am.direction="incoming"
-                and am.content_type not like "%sylk-api%"
-                and am.content_type != "application/blink-call-history"
-                and am.state not in ('deleted', 'displayed')
-                and {self._get_enabled_account_filter('am')}
-                group by am.remote_uri order by am.timestamp desc"""
+                select display_name, remote_uri, max(last_timestamp) from {Conversation.sqlmeta.table}
+                where unread > 0 and {self._get_enabled_account_filter()}
+                group by remote_uri order by max(last_timestamp) desc"""
         else:
             query = f"""
-                select im.display_name, am.remote_uri, max(am.timestamp) from messages as am
-                left join (select display_name, remote_uri from messages where direction="incoming" group by remote_uri) as im
-                on am.remote_uri = im.remote_uri
-                where
-                am.content_type not like "%pgp%"
-                and am.content_type not like "%sylk-api%"
-                and am.content_type != "application/blink-call-history"
-                and am.state != 'deleted'
-                and {self._get_enabled_account_filter('am')}
-                group by am.remote_uri order by am.timestamp desc limit {Message.sqlrepr(number)}"""
+                select display_name, remote_uri, max(last_timestamp) from {Conversation.sqlmeta.table}
+                where {self._get_enabled_account_filter()}
+                group by remote_uri order by max(last_timestamp) desc limit {Message.sqlrepr(number)}"""
 
         notification_center = NotificationCenter()
         try:
@@ -905,64 +2093,78 @@ class MessageHistory(object, metaclass=Singleton):
         except Exception as e:
             return
 
-        #log.debug(f"== Contacts fetched: {len(list(result))}")
-        #result = [(display_name, uri) for (display_name, uri, timestamp) in result]
-        #results = list(result)
-
-        results = []
-        for r in result:
-            # find the display name sent by remote party
-            display_name = r[0]
-            uri = r[1]
-            timestamp = r[2]
-            query = f"""select display_name from messages
-                where remote_uri = '{uri}'
-                and direction = 'incoming' and remote_uri != display_name"""
-            try:
-                c = self.db.queryAll(query)
-            except Exception as e:
-                pass
-            else:
-                if len(list(c)) > 0:
-                    display_name = list(c)[0][0]
+        results = [(display_name or None, uri, timestamp) for (display_name, uri, timestamp) in result]
+        notification_center.post_notification('BlinkMessageHistoryLastContactsDidSucceed', data=NotificationData(contacts=results))
 
-            results.append((display_name, uri, timestamp))
+    @run_in_reader
+    def search(self, query, account=None, remote_uri=None, limit=50, offset=0):
+        notification_center = NotificationCenter()
+        log.debug(f'== Searching messages for {query!r} account={account} remote_uri={remote_uri} offset={offset}')
 
-        results = sorted(results, key=lambda tup: tup[2])
-        results.reverse()
-        notification_center.post_notification('BlinkMessageHistoryLastContactsDidSucceed', data=NotificationData(contacts=results))
+        conditions = ["m.state != 'deleted'"]
+        if account is not None:
+            conditions.append(f'm.account_id = {Message.sqlrepr(str(account))}')
+        if remote_uri is not None:
+            conditions.append(f'm.remote_uri = {Message.sqlrepr(remote_uri)}')
+
+        expression = self._search_expression(query)
+        if expression is None:
+            notification_center.post_notification('BlinkMessageHistorySearchDidSucceed', data=NotificationData(query=query, account=account, remote_uri=remote_uri, messages=[], offset=offset, more=False))
+            return
+
+        # Newest rows come first, ordering by rowid is resolved by the index itself
+        # so the query stops after limit + 1 matches regardless of the database size
+        if self.search_index:
+            def matches(schema):
+                return f"""from {schema}.{self.search_table} join {schema}.{Message.sqlmeta.table} as m on m.id = {self.search_table}.rowid
+                    where {self.search_table} match {Message.sqlrepr(expression)} and {' and '.join(conditions)}"""
+            order = f'order by {self.search_table}.rowid desc'
+        else:
+            patterns = [f"m.content like {Message.sqlrepr('%' + term + '%')}" for term in self.search_term_re.findall(query)]
+            def matches(schema):
+                return f"""from {schema}.{Message.sqlmeta.table} as m where {self.search_filter.format('m')} and {' and '.join(conditions + patterns)}"""
+            order = 'order by m.id desc'
 
-    @run_in_thread('db')
-    def get_unread_messages(self):
-        query = f"""select remote_uri, count(*) as c from messages where state != 'displayed' and direction='incoming' and {self._get_enabled_account_filter()} group by remote_uri"""
         try:
-            result = self.db.queryAll(query)
+            found = [(Message, row[0]) for row in self.db.queryAll(f'select m.id {matches("main")} {order} limit {int(limit) + 1} offset {int(offset)}')]
+            if self.archive and len(found) <= limit:
+                # archived messages continue the results once the messages table has no more matches
+                skipped = offset - self.db.queryOne(f'select count(*) {matches("main")}')[0] if offset and not found else 0
+                found += [(ArchivedMessage, row[0]) for row in self.db.queryAll(f'select m.id {matches("archive")} {order} limit {int(limit) + 1 - len(found)} offset {max(int(skipped), 0)}')]
+            more = len(found) > limit
+            found = found[:limit]
+            messages = {}
+            for cls in (Message, ArchivedMessage):
+                ids = [id for source, id in found if source is cls]
+                if ids:
+                    messages.update(((cls, message.id), message) for message in cls.select(IN(cls.q.id, ids)))
         except Exception as e:
+            log.warning(f'Message search for {query!r} failed: {e}')
+            notification_center.post_notification('BlinkMessageHistorySearchDidFail', data=NotificationData(query=query, account=account, remote_uri=remote_uri, offset=offset, error=str(e)))
             return
 
-        unread_messages = {}
-        for (remote_uri, c) in result:
-            unread_messages[remote_uri] = c
+        results = [messages[key] for key in found if key in messages]
+        notification_center.post_notification('BlinkMessageHistorySearchDidSucceed', data=NotificationData(query=query, account=account, remote_uri=remote_uri, messages=results, offset=offset, more=more))
+
+    @run_in_reader
+    def get_unread_messages(self):
+        try:
+            with self.store.connection() as connection:
+                unread_messages = self.store.unread_counts(connection, self._get_enabled_account_ids())
+        except Exception as e:
+            return
 
         notification_center = NotificationCenter()
         notification_center.post_notification('BlinkMessageHistoryUnreadMessagesDidLoad', data=NotificationData(unread_messages=unread_messages))
 
-    @run_in_thread('db')
+    @run_in_reader
     def get_all_contacts(self):
         log.debug('== Getting all contacts with messages')
 
         query = f"""
-            select im.display_name, am.remote_uri from messages as am
-            left join (select display_name, remote_uri from messages where direction='incoming' group by remote_uri) as im
-            on (am.remote_uri = im.remote_uri)
-            where
-            am.content_type not like '%pgp%'
-            and not am.content_type like '%sylk-api%'
-            and am.content_type != "application/blink-call-history"
-            and am.state != 'deleted'
-            and {self._get_enabled_account_filter('am')}
-            group by am.remote_uri
-            """
+            select display_name, remote_uri, max(last_timestamp) from {Conversation.sqlmeta.table}
+            where {self._get_enabled_account_filter()}
+            group by remote_uri"""
 
         notification_center = NotificationCenter()
         try:
@@ -970,57 +2172,355 @@ class MessageHistory(object, metaclass=Singleton):
         except Exception as e:
             return
 
-        results = []
-        for r in result:
-            # find the display name sent by remote party
-            display_name = r[0]
-            uri = r[1]
-            query = f"""select display_name from messages
-                where remote_uri = '{uri}'
-                and direction = 'incoming' and remote_uri != display_name"""
-            try:
-                c = self.db.queryAll(query)
-            except Exception as e:
-                pass
-            else:
-                if len(list(c)) > 0:
-                    display_name = list(c)[0][0]
-
-            results.append((display_name, uri))
-
-        log.debug(f"== Contacts fetched: {len(list(result))}")
+        results = [(display_name or None, uri) for (display_name, uri, timestamp) in result]
+        log.debug(f"== Contacts fetched: {len(results)}")
         notification_center.post_notification('BlinkMessageHistoryAllContactsDidSucceed', data=NotificationData(contacts=results))
 
     @run_in_thread('db')
+    @flush_pending_messages
     def remove(self, account):
-        Message.deleteBy(account=account)
+        log.info(f'== Removing all messages of {account.id}')
+        account_id = Message.sqlrepr(str(account.id))
+        remote_uris = {row[0] for row in self.db.queryAll(f'select remote_uri from {Conversation.sqlmeta.table} where account_id = {account_id}')}
+        unread_before = self._unread_counts(remote_uris)
+        self._remove_messages(f'account_id = {account_id}', account=account, remote_uri=None)
+        self._post_unread_changes(unread_before, self._unread_counts(remote_uris))
 
     @run_in_thread('db')
+    @flush_pending_messages
     def remove_contact_messages(self, account, contact, timestamp=None, session=None):
         if not timestamp:
             timestamp = ISOTimestamp.now()
 
-        timestamp_native = timestamp
-        timestamp_utc = timestamp_native.replace(tzinfo=timezone.utc)
-        timestamp_fixed = timestamp_utc - timestamp.utcoffset()
-        timestamp = parse(str(timestamp_fixed))
+        timestamp = utc_timestamp(timestamp)
 
         log.info(f'== Removing conversation between {account.id} <-> {contact} < {timestamp}')
-        result = Message.selectBy(remote_uri=contact, account_id=str(account.id))
-        for message in result:
-            if message.timestamp.replace(tzinfo=timezone.utc) <= timestamp:
-                message.destroySelf()
+        unread_before = self._unread_counts({contact})
+        condition = f'remote_uri = {Message.sqlrepr(contact)} and account_id = {Message.sqlrepr(str(account.id))} and timestamp_us <= {epoch_microseconds(timestamp)}'
+        self._remove_messages(condition, account=account, remote_uri=contact)
+        self._post_unread_changes(unread_before, self._unread_counts({contact}))
         if session:
             self.load(contact, session)
 
 
     @run_in_thread('db')
+    @flush_pending_messages
     def remove_message(self, id):
         log.debug(f'== Trying to removing message: {id}')
-        result = Message.selectBy(message_id=id)
+        result = list(Message.selectBy(message_id=id))
+        remote_uris = {message.remote_uri for message in result if message.direction == 'incoming'}
+        unread_before = self._unread_counts(remote_uris)
+        if self.archive:
+            result += list(ArchivedMessage.selectBy(message_id=id))
         for message in result:
             log.info(f'== Removing message: {id}')
             message.destroySelf()
+        self._post_unread_changes(unread_before, self._unread_counts(remote_uris))
+
+    def _retention_steps(self):
+        table = Message.sqlmeta.table
+        settings = BlinkSettings()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        def older_than(days):
+            return f'timestamp_us < {epoch_microseconds(now - timedelta(days=days))}'
+
+        # unread messages are kept until they are displayed
+        keep_unread = f'not {self.conversation_unread.format(table)}'
+        conditions = []
+        for account in AccountManager().iter_accounts():
+            if isinstance(account, Account) and account.sms.history_retention:
+                conditions.append(f'account_id = {Message.sqlrepr(str(account.id))} and {older_than(account.sms.history_retention)}')
+        for policy in settings.message_history.retention:
+            if not policy.days:
+                continue
+            if policy.content_type.endswith('/*'):
+                conditions.append(f"content_type like {Message.sqlrepr(policy.content_type[:-1] + '%')} and {older_than(policy.days)}")
+            else:
+                conditions.append(f'content_type = {Message.sqlrepr(policy.content_type)} and {older_than(policy.days)}')
+
+        tables = [Message.sqlmeta.table, ArchivedMessage.sqlmeta.table] if self.archive else [Message.sqlmeta.table]
+        steps = [('remove', target, f'{condition} and {keep_unread}') for condition in conditions for target in tables]
+        if settings.message_history.archive_after and self.archive:
+            steps.append(('archive', table, f'{older_than(settings.message_history.archive_after)} and {keep_unread}'))
+        return steps
+
+    def _archive_chunk(self, condition):
+        table = Message.sqlmeta.table
+        columns = ', '.join(column.dbName for column in Message.sqlmeta.columnList)
+        # Commits are only atomic per database file, a row that was copied but not removed is skipped by the unique index next time
+        transaction = self.db.transaction()
+        try:
+            ids = [row[0] for row in transaction.queryAll(f'select id from main.{table} where {condition} limit {self.retention_chunk_size}')]
+            if ids:
+                id_list = ', '.join(str(id) for id in ids)
+                transaction.query(f'insert or ignore into archive.{table} ({columns}) select {columns} from main.{table} where id in ({id_list})')
+                transaction.query(f'delete from main.{table} where id in ({id_list})')
+            transaction.commit(close=True)
+        except dberrors.Error as e:
+            transaction.rollback()
+            log.warning(f'Failed to archive messages: {e}')
+            return 0
+        return len(ids)
+
+    @run_in_thread('db', scheduled=True)
+    def apply_retention(self, steps=None, removed=0, archived=0):
+        # Like the compression job, each chunk is a separate task on the db thread so the writer is only held briefly
+        if steps is None:
+            if self._retention_running:
+                return
+            self._retention_running = True
+            steps = self._retention_steps()
+
+        notification_center = NotificationCenter()
+        if not steps:
+            self._retention_running = False
+            if removed or archived:
+                log.info(f'== Retention policies removed {removed} and archived {archived} messages')
+                self._schedule_vacuum()
+            notification_center.post_notification('BlinkMessageHistoryRetentionDidEnd', sender=self, data=NotificationData(removed=removed, archived=archived))
+            return
+
+        action, table, condition = steps[0]
+        if action == 'archive':
+            count = self._archive_chunk(condition)
+            archived += count
+        else:
+            count = self._remove_chunk(table, condition, self.retention_chunk_size)
+            removed += count
+        if count < self.retention_chunk_size:
+            steps = steps[1:]
+        if count:
+            notification_center.post_notification('BlinkMessageHistoryRetentionDidProgress', sender=self, data=NotificationData(removed=removed, archived=archived))
+        self.apply_retention(steps, removed, archived)
+
+    def _compress_messages(self, condition):
+        if zstandard is None:
+            return 0, 0
+        threshold = BlinkSettings().message_history.compression_threshold
+        table = Message.sqlmeta.table
+        query = f"""select id, case when {self.compression_filter.format(table, threshold)} then content end,
+                          case when typeof(decryption_error) = 'text' and length(decryption_error) >= {threshold} then decryption_error end
+                   from {table} where ({condition}) and ({self.compression_filter.format(table, threshold)} or (typeof(decryption_error) = 'text' and length(decryption_error) >= {threshold}))
+                   limit {self.compression_chunk_size}"""
+        try:
+            rows = self.db.queryAll(query)
+        except dberrors.Error as e:
+            log.warning(f'Failed to select messages for compression: {e}')
+            return 0, 0
+        if not rows:
+            return 0, 0
+
+        compressor = zstandard.ZstdCompressor(level=self.compression_level)
+        size_before = size_after = 0
+        updates = []
+        for id, content, decryption_error in rows:
+            values = []
+            for value in (content, decryption_error):
+                if value is not None:
+                    data = value.encode()
+                    compressed = compressor.compress(data)
+                    # keep the text when compression does not pay off, the next pass will not pick it again
+                    value = compressed if len(compressed) < len(data) else None
+                    size_before += len(data) if value is not None else 0
+                    size_after += len(value) if value is not None else 0
+                values.append(value)
+            if values != [None, None]:
+                updates.append((values[0], values[1], id))
+
+        # Compressed values are bound as parameters so SQLite stores them as BLOBs
+        connection = self.db.getConnection()
+        try:
+            connection.execute('begin')
+            connection.executemany(f'update {table} set content = coalesce(?, content), decryption_error = coalesce(?, decryption_error) where id = ?', updates)
+            connection.execute('commit')
+        except sqlite3.Error as e:
+            connection.execute('rollback')
+            log.warning(f'Failed to compress messages: {e}')
+            return 0, 0
+        finally:
+            self.db.releaseConnection(connection)
+        return len(rows), size_before - size_after
+
+    @run_in_thread('db', scheduled=True)
+    def compress_history(self, processed=0, saved=0, last_id=None):
+        # Each chunk is a separate task on the db thread, so new messages are not held back while the job runs.
+        # The last processed id is kept with the table versions, an interrupted job resumes where it stopped.
+        if not BlinkSettings().message_history.compression or zstandard is None:
+            return
+        checkpoint = f'{Message.sqlmeta.table}_compression'
+        if last_id is None:
+            last_id = self.table_versions.version(checkpoint) or 0
+        rows = self.db.queryAll(f'select max(id) from (select id from {Message.sqlmeta.table} where id > {last_id} order by id limit {self.compression_chunk_size})')
+        next_id = rows[0][0] if rows else None
+        notification_center = NotificationCenter()
+        if next_id is None:
+            log.info(f'== Compressed {processed} messages, saved {saved} bytes')
+            notification_center.post_notification('BlinkMessageHistoryCompressionDidEnd', sender=self, data=NotificationData(processed=processed, saved=saved))
+            if saved:
+                self._schedule_vacuum()
+            return
+        count, chunk_saved = self._compress_messages(f'id > {last_id} and id <= {next_id}')
+        processed += count
+        saved += chunk_saved
+        self.table_versions.set_version(checkpoint, next_id)
+        notification_center.post_notification('BlinkMessageHistoryCompressionDidProgress', sender=self, data=NotificationData(processed=processed, saved=saved))
+        self.compress_history(processed, saved, next_id)
+
+    # Archives are newline delimited JSON, compressed with zstd when the file name ends in .zst
+
+    @staticmethod
+    def _open_archive(filename, mode):
+        if not filename.endswith('.zst'):
+            return open(filename, 'wb') if mode == 'w' else open(filename, 'r', encoding='utf-8')
+        if zstandard is None:
+            raise RuntimeError('zstd compression is not available, the zstandard module is not installed')
+        if mode == 'w':
+            return zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'), closefd=True)
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True), encoding='utf-8')
+
+    @run_in_thread('db')
+    @flush_pending_messages
+    def export(self, filename):
+        self._export(filename)
+
+    @run_in_thread('history-archive', scheduled=True)
+    def _export(self, filename):
+        notification_center = NotificationCenter()
+        columns = [column.dbName for column in Message.sqlmeta.columnList]
+        log.info(f'== Exporting message history to {filename}')
+
+        exported = 0
+        start_time = time.monotonic()
+        try:
+            # Messages moved to the archive by the retention policies are exported after the others
+            tables = [f'main.{Message.sqlmeta.table}']
+            if self.archive and self._attach_archive_once():
+                tables.append(f'archive.{Message.sqlmeta.table}')
+            total = sum(self.db.queryOne(f'select count(*) from {table}')[0] for table in tables)
+            with self._open_archive(filename, 'w') as archive:
+                for table in tables:
+                    last_id = 0
+                    # Walk the table in primary key order one page at a time, memory use does not depend on the history size
+                    while True:
+                        rows = self.db.queryAll(f'select id, {", ".join(columns)} from {table} where id > {last_id} order by id limit {self.archive_batch_size}')
+                        if not rows:
+                            break
+                        archive.write(b''.join(json.dumps({name: decompress_text(value) if isinstance(value, bytes) else value for name, value in zip(columns, row[1:])}, default=str).encode() + b'\n' for row in rows))
+                        last_id = rows[-1][0]
+                        exported += len(rows)
+                        elapsed = time.monotonic() - start_time
+                        notification_center.post_notification('BlinkMessageHistoryExportDidProgress', sender=self, data=NotificationData(filename=filename, exported=exported, total=total, rate=exported / elapsed if elapsed else 0))
+        except Exception as e:
+            log.warning(f'Failed to export message history to {filename}: {e}')
+            notification_center.post_notification('BlinkMessageHistoryExportDidFail', sender=self, data=NotificationData(filename=filename, exported=exported, error=str(e)))
+            return
+
+        elapsed = time.monotonic() - start_time
+        log.info(f'== Exported {exported} messages to {filename} in {elapsed:.1f} seconds')
+        notification_center.post_notification('BlinkMessageHistoryExportDidEnd', sender=self, data=NotificationData(filename=filename, exported=exported, elapsed=elapsed))
+
+    @run_in_thread('history-archive', scheduled=True)
+    def import_archive(self, filename):
+        notification_center = NotificationCenter()
+        columns = {column.dbName for column in Message.sqlmeta.columnList}
+        log.info(f'== Importing message history from {filename}')
+
+        read = 0
+        imported = 0
+        start_time = time.monotonic()
+        try:
+            with self._open_archive(filename, 'r') as archive:
+                batch = []
+                for line in archive:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    fields = {name: value for name, value in record.items() if name in columns}
+                    fields['timestamp'] = utc_timestamp(parse(fields['timestamp']))
+                    batch.append(fields)
+                    if len(batch) < self.archive_batch_size:
+                        continue
+                    read += len(batch)
+                    imported += self._import_messages(batch).result()
+                    batch = []
+                    elapsed = time.monotonic() - start_time
+                    notification_center.post_notification('BlinkMessageHistoryImportDidProgress', sender=self, data=NotificationData(filename=filename, read=read, imported=imported, rate=read / elapsed if elapsed else 0))
+                if batch:
+                    read += len(batch)
+                    imported += self._import_messages(batch).result()
+        except Exception as e:
+            log.warning(f'Failed to import message history from {filename}: {e}')
+            notification_center.post_notification('BlinkMessageHistoryImportDidFail', sender=self, data=NotificationData(filename=filename, read=read, imported=imported, error=str(e)))
+            return
+
+        elapsed = time.monotonic() - start_time
+        log.info(f'== Imported {imported} of {read} messages from {filename} in {elapsed:.1f} seconds')
+        notification_center.post_notification('BlinkMessageHistoryImportDidEnd', sender=self, data=NotificationData(filename=filename, read=read, imported=imported, duplicates=read - imported, elapsed=elapsed))
+
+    def _import_messages(self, records):
+        # The reader waits for each batch to be stored, so at most one batch is held in memory
+        future = Future()
+        self._store_imported_messages(records, future)
+        return future
+
+    @run_in_thread('db')
+    def _store_imported_messages(self, records, future):
+        # Imported messages are stored in their own transaction, apart from the queued live messages.
+        # Messages already in the history are skipped by the unique (message_id, account_id, remote_uri) index.
+        try:
+            stored, unread_before, unread_after = self._insert_messages([PendingMessage(fields, None, 'import', notify=False) for fields in records])
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self._post_unread_changes(unread_before, unread_after)
+        if stored and BlinkSettings().message_history.compression:
+            self._compress_messages(f"id in ({', '.join(str(message.id) for item, message in stored)})")
+        future.set_result(len(stored))
+
+    def _attach_archive_once(self):
+        # The archive is attached to each connection once, returns whether it is available on the calling thread
+        try:
+            if not any(row[1] == 'archive' for row in self.db.queryAll('pragma database_list')):
+                self._attach_archive()
+        except dberrors.Error as e:
+            log.warning(f'Failed to attach message history archive: {e}')
+            return False
+        return True
+
+    @staticmethod
+    def _backup_database(source_filename, target_filename):
+        # The backup runs in a single step on its own connection, in WAL mode it sees one
+        # consistent version of the database and does not block the writer
+        source = sqlite3.connect(source_filename)
+        try:
+            target = sqlite3.connect(target_filename)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    @run_in_thread('history-archive', scheduled=True)
+    def snapshot(self, filename):
+        # The archive database is saved next to the snapshot, as <name>-archive<extension>
+        notification_center = NotificationCenter()
+        start_time = time.monotonic()
+        archive_filename = None
+        try:
+            self._backup_database(ApplicationData.get('message_history.db'), filename)
+            if self.archive:
+                name, extension = os.path.splitext(filename)
+                archive_filename = f'{name}-archive{extension}'
+                self._backup_database(ApplicationData.get('message_history_archive.db'), archive_filename)
+        except (OSError, sqlite3.Error) as e:
+            log.warning(f'Failed to create message history snapshot {filename}: {e}')
+            notification_center.post_notification('BlinkMessageHistorySnapshotDidFail', sender=self, data=NotificationData(filename=filename, error=str(e)))
+            return
+        elapsed = time.monotonic() - start_time
+        log.info(f'== Message history snapshot saved to {filename}' + (f' and {archive_filename}' if archive_filename else '') + f' in {elapsed:.1f} seconds')
+        notification_center.post_notification('BlinkMessageHistorySnapshotDidEnd', sender=self, data=NotificationData(filename=filename, archive_filename=archive_filename, elapsed=elapsed))
 
 
 class IconDescriptor(object):
@@ -1049,7 +2549,7 @@ class HistoryEntry(object):
     incoming_failed_icon = IconDescriptor(Resources.get('icons/arrow-inward-red.svg'))
     outgoing_failed_icon = IconDescriptor(Resources.get('icons/arrow-outward-red.svg'))
 
-    def __init__(self, direction, name, uri, account_id, call_time, duration, failed=False, reason=None):
+    def __init__(self, direction, name, uri, account_id, call_time, duration, failed=False, reason=None, media=()):
         self.direction = direction
         self.name = name
         self.uri = uri
@@ -1058,9 +2558,10 @@ class HistoryEntry(object):
         self.duration = duration
         self.failed = failed
         self.reason = reason
+        self.media = media
 
     def __reduce__(self):
-        return self.__class__, (self.direction, self.name, self.uri, self.account_id, self.call_time, self.duration, self.failed, self.reason)
+        return self.__class__, (self.direction, self.name, self.uri, self.account_id, self.call_time, self.duration, self.failed, self.reason, self.media)
 
     def __eq__(self, other):
         return self is other
@@ -1145,4 +2646,11 @@ class HistoryEntry(object):
             display_name = session.remote_identity.display_name
         else:
             display_name = contact.name
-        return cls(session.direction, display_name, remote_uri, str(session.account.id), call_time, duration)
+        media = sorted({stream.type for stream in session.streams or session.proposed_streams or []})
+        return cls(session.direction, display_name, remote_uri, str(session.account.id), call_time, duration, media=media)
+
+    @classmethod
+    def from_call(cls, call):
+        call_time = ISOTimestamp(call.call_time.replace(tzinfo=timezone.utc))
+        duration = timedelta(seconds=call.duration) if call.duration is not None else None
+        return cls(call.direction, call.display_name or None, call.uri, call.account_id, call_time, duration, call.failed, call.reason or None, call.media.split(',') if call.media else [])
@@ -63,7 +63,7 @@ class MainWindow(base_class, ui_class):
         notification_center.add_observer(self, name='BlinkUnreadMessagesChanged')
         notification_center.add_observer(self, name='ChatSessionUnreadMessagesCountChanged')
         notification_center.add_observer(self, name='BlinkMessageHistoryUnreadMessagesDidLoad')
-        notification_center.add_observer(self, name='BlinkMessageNewUnread')
+        notification_center.add_observer(self, name='BlinkMessageHistoryUnreadMessagesDidChange')
         notification_center.add_observer(self, name='BlinkMessageHistoryMessageDidStore')
         notification_center.add_observer(self, name='BlinkSessionConfirmReadMessages')
         notification_center.add_observer(self, name='BlinkConfirmReadMessagesOnOtherDevice')
@@ -74,6 +74,7 @@ class MainWindow(base_class, ui_class):
 
         self.pending_watcher_dialogs = []
         self.unread_messages = {}
+        self._total_unread_messages = 0
 
         self.mwi_icons = [QIcon(Resources.get('icons/mwi-%d.png' % i)) for i in range(0, 11)]
         self.mwi_icons.append(QIcon(Resources.get('icons/mwi-many.png')))
@@ -855,28 +856,24 @@ class MainWindow(base_class, ui_class):
 
     @property
     def total_unread_messages(self):
-        new_messages = 0
-        for k in self.unread_messages.copy().keys():
-            new_messages = new_messages + self.unread_messages[k]
-        return new_messages
+        return self._total_unread_messages
+
+    def _set_unread_messages(self, uri, count):
+        self._total_unread_messages += count - self.unread_messages.pop(uri, 0)
+        if count > 0:
+            self.unread_messages[uri] = count
 
     @run_in_gui_thread
     def _NH_BlinkConfirmReadMessagesOnOtherDevice(self, notification):
-        try:
-            del(self.unread_messages[notification.data.remote_uri])
-        except KeyError:
-            pass
-        else:
+        if notification.data.remote_uri in self.unread_messages:
+            self._set_unread_messages(notification.data.remote_uri, 0)
             NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
 
     @run_in_gui_thread
     def _NH_BlinkSessionConfirmReadMessages(self, notification):
         uri = str(notification.sender.uri).partition(':')[2]
-        try:
-            del(self.unread_messages[uri])
-        except KeyError:
-            pass
-        else:
+        if uri in self.unread_messages:
+            self._set_unread_messages(uri, 0)
             NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
 
     @run_in_gui_thread
@@ -889,30 +886,17 @@ class MainWindow(base_class, ui_class):
         self.open_unread_messages_button.setVisible(bool(self.total_unread_messages))
         self.active_sessions_label.setVisible(False)
 
-    def _NH_BlinkMessageNewUnread(self, notification):
-        uri = notification.sender
-
-        try:
-            self.unread_messages[uri]
-        except KeyError:
-            self.unread_messages[uri] = 1
-        else:
-            self.unread_messages[uri] = self.unread_messages[uri] + 1
+    def _NH_BlinkMessageHistoryUnreadMessagesDidChange(self, notification):
+        # The history only sends the counters that changed, a conversation already
+        # confirmed as read in the UI does not go below zero
+        for uri, delta in notification.data.changes.items():
+            self._set_unread_messages(uri, max(self.unread_messages.get(uri, 0) + delta, 0))
 
         NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
 
     def _NH_BlinkMessageHistoryUnreadMessagesDidLoad(self, notification):
-        unread_messages = notification.data.unread_messages
-        total = 0
-        self.unread_messages = {}
-        for k in unread_messages.keys():
-            try:
-                um = self.unread_messages[k]
-            except KeyError:
-                self.unread_messages[k] = unread_messages[k]
-            else:
-                self.unread_messages[k] = self.unread_messages[k] + unread_messages[k]
-            total = total + self.unread_messages[k]
+        self.unread_messages = {uri: count for uri, count in notification.data.unread_messages.items() if count > 0}
+        self._total_unread_messages = sum(self.unread_messages.values())
 
         NotificationCenter().post_notification('BlinkUnreadMessagesChanged')
 
@@ -1,18 +1,26 @@
 import bisect
+import codecs
 import dns.resolver
+import heapq
 import json
 import os
 import re
 import requests
 import random
+import time
 import urllib
 import uuid
 import pgpy
 
 from collections import deque
+from concurrent.futures import Future
+from contextlib import closing
+from functools import partial
+from itertools import count
+from threading import Lock
 
 from PyQt6 import uic
-from PyQt6.QtCore import Qt, QObject, pyqtSignal
+from PyQt6.QtCore import Qt, QObject, QTimer, pyqtSignal
 from PyQt6.QtWidgets import QApplication, QDialogButtonBox, QStyle, QDialog
 
 from pgpy import PGPMessage
@@ -20,6 +28,7 @@ from pgpy.errors import PGPEncryptionError, PGPDecryptionError
 
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
+from application.python.threadpool import ThreadPool
 from application.system import makedirs, host
 from application.python.types import Singleton
 from datetime import datetime, timezone, timedelta
@@ -42,9 +51,11 @@ from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
 
 from blink.configuration.datatypes import File
+from blink.configuration.settings import BlinkSettings
 from blink.logging import MessagingTrace as log
 from blink.resources import Resources
 from blink.sessions import SessionManager, StreamDescription, IncomingDialogBase
+from blink.streams.message import PGPKeyCache
 from blink.util import run_in_gui_thread, translate
 
 __all__ = ['MessageManager', 'BlinkMessage']
@@ -54,6 +65,40 @@ dns_error_map = {dns.resolver.NXDOMAIN: 'Domain not found in DNS',
                  dns.resolver.NoNameservers: 'no DNS name servers could be reached',
                  dns.resolver.Timeout: 'no DNS response received, the query has timed out'}
 
+
+def iter_json_array(chunks, key):
+    """Yield the items of the array stored under key in a JSON document, decoding each of them as soon as its chunks arrived"""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buffer = ''
+    index = None
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        if index is None:
+            match = array_start.search(buffer)
+            if match is None:
+                continue
+            index = match.end()
+        while True:
+            while index < len(buffer) and buffer[index] in ' \t\r\n,':
+                index += 1
+            if index == len(buffer):
+                break
+            if buffer[index] == ']':
+                return
+            try:
+                item, index = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                break  # the item is not complete yet
+            yield item
+        buffer = buffer[index:]
+        index = 0
+    if index is None:
+        raise ValueError(f'the {key} array was not found')
+    raise ValueError(f'the {key} array is not complete')
+
+
 ui_class, base_class = uic.loadUiType(Resources.get('generate_pgp_key_dialog.ui'))
 
 
@@ -337,13 +382,113 @@ class OTRInternalMessage(BlinkMessage):
         super(OTRInternalMessage, self).__init__(content, 'text/plain')
 
 
+class PendingRouteLookup(object):
+    def __init__(self, key):
+        self.key = key
+        self.ttl = None
+        self.failure_reason = None
+        self.messages = []
+
+
+@implementer(IObserver)
+class RouteCache(object, metaclass=Singleton):
+    """Routes found for outgoing messages, shared until the DNS records they came from expire"""
+
+    default_ttl = 60   # seconds, for targets resolved without DNS records
+    max_ttl = 3600
+
+    def __init__(self):
+        self._routes = {}   # key -> (routes, expiration time)
+        self._pending = {}  # key -> DNSLookup in progress
+        self._lookups = {}  # DNSLookup -> PendingRouteLookup
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='NetworkConditionsDidChange')
+
+    @run_in_gui_thread
+    def lookup(self, message, uri, transport_list, tls_name):
+        key = (message.account.id, str(uri), tuple(transport_list), tls_name)
+        message.route_key = key
+        try:
+            routes, expiration = self._routes[key]
+        except KeyError:
+            pass
+        else:
+            if expiration > time.monotonic():
+                message._lookup_did_succeed(routes)
+                return
+            del self._routes[key]
+        try:
+            lookup = self._pending[key]
+        except KeyError:
+            lookup = self._pending[key] = DNSLookup()
+            self._lookups[lookup] = PendingRouteLookup(key)
+            self._lookups[lookup].messages.append(message)
+            notification_center = NotificationCenter()
+            notification_center.add_observer(self, sender=lookup)
+            lookup.lookup_sip_proxy(uri, transport_list, tls_name=tls_name)
+        else:
+            self._lookups[lookup].messages.append(message)
+
+    @run_in_gui_thread
+    def invalidate(self, key=None):
+        if key is None:
+            self._routes.clear()
+            self._pending.clear()
+        else:
+            self._routes.pop(key, None)
+            self._pending.pop(key, None)
+
+    def _lookup_did_end(self, lookup):
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, sender=lookup)
+        pending = self._lookups.pop(lookup)
+        # the lookup is only reused and cached if it was not invalidated meanwhile
+        current = self._pending.get(pending.key) is lookup
+        if current:
+            del self._pending[pending.key]
+        return pending, current
+
+    @run_in_gui_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_NetworkConditionsDidChange(self, notification):
+        self.invalidate()
+
+    def _NH_DNSLookupTrace(self, notification):
+        pending = self._lookups.get(notification.sender)
+        if pending is None:
+            return
+        if notification.data.error and notification.data.query_type == 'A':
+            pending.failure_reason = dns_error_map.get(notification.data.error.__class__, '')
+        rrset = getattr(getattr(notification.data, 'answer', None), 'rrset', None)
+        if rrset is not None:
+            pending.ttl = rrset.ttl if pending.ttl is None else min(pending.ttl, rrset.ttl)
+
+    def _NH_DNSLookupDidSucceed(self, notification):
+        pending, current = self._lookup_did_end(notification.sender)
+        routes = notification.data.result
+        ttl = min(self.default_ttl if pending.ttl is None else pending.ttl, self.max_ttl)
+        if current and routes and ttl > 0:
+            self._routes[pending.key] = routes, time.monotonic() + ttl
+        for message in pending.messages:
+            message._lookup_did_succeed(routes)
+
+    def _NH_DNSLookupDidFail(self, notification):
+        pending, current = self._lookup_did_end(notification.sender)
+        for message in pending.messages:
+            message.dns_failed_reason = pending.failure_reason
+            message._lookup_did_fail(notification.data.error)
+
+
 @implementer(IObserver)
 class OutgoingMessage(object):
     __ignored_content_types__ = {IsComposingDocument.content_type, IMDNDocument.content_type}  # Content types to ignore in notifications
     __disabled_imdn_content_types__ = {'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-api'}.union(__ignored_content_types__)  # Content types to ignore in notifications
 
     def __init__(self, account, contact, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None, id=None, session=None, use_cpim=True):
-        self.lookup = None
+        self.route_key = None
         self.account = account
         self.uri = contact.uri.uri
         self.content_type = content_type
@@ -378,10 +523,7 @@ class OutgoingMessage(object):
         else:
             uri = self.sip_uri
 
-        self.lookup = DNSLookup()
-        notification_center = NotificationCenter()
-        notification_center.add_observer(self, sender=self.lookup)
-        self.lookup.lookup_sip_proxy(uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name or uri.host)
+        RouteCache().lookup(self, uri, settings.sip.transport_list, tls_name=self.account.sip.tls_name or uri.host)
 
     def _send(self, routes=None):
         if routes is not None or self.session.routes:
@@ -477,46 +619,37 @@ class OutgoingMessage(object):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
-    def _NH_DNSLookupTrace(self, notification):
-        if notification.data.error and notification.data.query_type == 'A':
-            reason = dns_error_map.get(notification.data.error.__class__, '')
-            self.dns_failed_reason = reason
-
-    def _NH_DNSLookupDidSucceed(self, notification):
-        notification.center.remove_observer(self, sender=notification.sender)
-        if notification.sender is self.lookup:
-            routes = notification.data.result
-            if self.content_type.lower() in ['text/pgp-private-key', 'application/sylk-api-token']:
-                self._send(routes)
-                return
-
-            # TODO: Figure out how now to send a public key when required, not always on start of the first message in the session -Tijmen
-            if self.content_type != 'text/pgp-public-key' and not self.session.routes:
-                stream = self.session.fake_streams.get('messages')
-                if stream and self.session.account.sms.enable_pgp and stream.can_decrypt:
-                    directory = os.path.join(SIPSimpleSettings().chat.keys_directory.normalized, 'private')
-                    filename = os.path.join(directory, f'{self.session.account.id}')
-
-                    with open(f'{filename}.pubkey', 'rb') as f:
-                        public_key = f.read().decode()
-                    public_key_message = OutgoingMessage(self.session.account, self.contact, str(public_key), 'text/pgp-public-key', session=self.session)
-                    MessageManager()._send_message(public_key_message)
-                if stream and self.account is not BonjourAccount() and self.account.sms.enable_pgp and not stream.can_encrypt:
-                    lookup_message = OutgoingMessage(self.account, self.contact, 'Public key request', 'application/sylk-api-pgp-key-lookup', session=self.session)
-                    lookup_message.send()
-            self.session.routes = routes
-            self._send()
+    def _lookup_did_succeed(self, routes):
+        if self.content_type.lower() in ['text/pgp-private-key', 'application/sylk-api-token']:
+            self._send(routes)
+            return
 
-    def _NH_DNSLookupDidFail(self, notification):
-        notification.center.remove_observer(self, sender=notification.sender)
+        # TODO: Figure out how now to send a public key when required, not always on start of the first message in the session -Tijmen
+        if self.content_type != 'text/pgp-public-key' and not self.session.routes:
+            stream = self.session.fake_streams.get('messages')
+            if stream and self.session.account.sms.enable_pgp and stream.can_decrypt:
+                directory = os.path.join(SIPSimpleSettings().chat.keys_directory.normalized, 'private')
+                filename = os.path.join(directory, f'{self.session.account.id}')
+
+                with open(f'{filename}.pubkey', 'rb') as f:
+                    public_key = f.read().decode()
+                public_key_message = OutgoingMessage(self.session.account, self.contact, str(public_key), 'text/pgp-public-key', session=self.session)
+                MessageManager()._send_message(public_key_message)
+            if stream and self.account is not BonjourAccount() and self.account.sms.enable_pgp and not stream.can_encrypt:
+                lookup_message = OutgoingMessage(self.account, self.contact, 'Public key request', 'application/sylk-api-pgp-key-lookup', session=self.session)
+                lookup_message.send()
+        self.session.routes = routes
+        self._send()
+
+    def _lookup_did_fail(self, error):
         if self.content_type.lower() == IsComposingDocument.content_type:
             return
 
         if self.session is None:
             return
 
-        reason = self.dns_failed_reason or notification.data.error
-        originator = 'local' if 'no DNS' in self.dns_failed_reason else 'remote'
+        reason = self.dns_failed_reason or error
+        originator = 'local' if self.dns_failed_reason and 'no DNS' in self.dns_failed_reason else 'remote'
 
         log.info(f'DNS lookup for message {self.id} failed {originator}ly: {reason}')
 
@@ -538,6 +671,10 @@ class OutgoingMessage(object):
             notification_center.post_notification('BlinkMessageDidSucceed', sender=self.session, data=NotificationData(data=notification.data, id=self.id))
 
     def _NH_SIPMessageDidFail(self, notification):
+        if self.route_key is not None and (not hasattr(notification.data, 'headers') or notification.data.code in (408, 503)):
+            # the transport or the route failed, resolve it again for the next message
+            RouteCache().invalidate(self.route_key)
+
         if self.__disabled_imdn_content_types__:
             return
 
@@ -613,15 +750,11 @@ class InternalOTROutgoingMessage(OutgoingMessage):
         else:
             self._lookup()
 
-    def _NH_DNSLookupDidSucceed(self, notification):
-        notification.center.remove_observer(self, sender=notification.sender)
-        if notification.sender is self.lookup:
-            routes = notification.data.result
-            self.session.routes = routes
-            self._send()
+    def _lookup_did_succeed(self, routes):
+        self.session.routes = routes
+        self._send()
 
-    def _NH_DNSLookupDidFail(self, notification):
-        notification.center.remove_observer(self, sender=notification.sender)
+    def _lookup_did_fail(self, error):
         return
 
     def _NH_SIPMessageDidSucceed(self, notification):
@@ -642,32 +775,313 @@ class RequestList(list):
             return [item for item in self if item.account is key]
 
 
+class HistorySyncScheduler(object):
+    """Runs the server history synchronization of several accounts at the same time"""
+
+    max_threads = 16
+    interval = 500  # seconds, an account is synchronized at most once per interval unless forced
+    retry_delay = 30  # seconds, doubled after every failure of the same server
+    retry_max_delay = 30 * 60  # seconds
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.metrics = {}
+        self.pool = ThreadPool(name='history-sync', min_threads=1, max_threads=self.max_threads)
+        self.pool.start()
+        # The scheduler state is only used in the GUI thread
+        self._queue = []
+        self._queued = {}
+        self._running = set()
+        self._rerun = set()
+        self._last_sync = {}
+        self._backoff = {}
+        self._sequence = count()
+        self._retry_timer = QTimer()
+        self._retry_timer.setSingleShot(True)
+        self._retry_timer.timeout.connect(self._start_jobs)
+
+    @staticmethod
+    def _server(account):
+        return urlsplit(account.sms.history_synchronization_url or '').netloc
+
+    @run_in_gui_thread
+    def schedule(self, account, force=False):
+        if account.id in self._running:
+            if force:
+                self._rerun.add(account.id)
+            return
+        if account.id in self._queued:
+            return
+        last_sync = self._last_sync.get(account.id)
+        if not force and last_sync is not None and time.monotonic() - last_sync < self.interval:
+            log.debug(f'History synchronization skipped for {account.id}, will only sync on interval > {self.interval}s')
+            return
+        # Accounts with open conversations go first
+        priority = 0 if any(session.account is account for session in self.manager.sessions) else 1
+        heapq.heappush(self._queue, (priority, next(self._sequence), account))
+        self._queued[account.id] = account
+        self._start_jobs()
+
+    def _start_jobs(self):
+        limit = min(BlinkSettings().message_history.sync_concurrency, self.max_threads)
+        now = time.monotonic()
+        deferred = []
+        while self._queue and len(self._running) < limit:
+            item = heapq.heappop(self._queue)
+            account = item[2]
+            failures, retry_time = self._backoff.get(self._server(account), (0, 0))
+            if retry_time > now:
+                deferred.append(item)
+                continue
+            del self._queued[account.id]
+            self._running.add(account.id)
+            self.pool.run(self._run, account)
+        for item in deferred:
+            heapq.heappush(self._queue, item)
+        if deferred:
+            # accounts of servers that failed wait for the earliest retry time
+            retry_time = min(self._backoff[self._server(item[2])][1] for item in deferred)
+            self._retry_timer.start(int((retry_time - now) * 1000) + 1)
+
+    def _run(self, account):
+        start_time = time.monotonic()
+        try:
+            status, messages = self.manager._sync_messages(account)
+        except Exception as e:
+            log.exception(f'History synchronization of {account.id} failed: {e}')
+            status, messages = 'error', 0
+        self._job_did_end(account, status, messages, time.monotonic() - start_time)
+
+    @run_in_gui_thread
+    def _job_did_end(self, account, status, messages, duration):
+        self._running.discard(account.id)
+        server = self._server(account)
+
+        metrics = self.metrics.setdefault(account.id, dict(synchronizations=0, failures=0, messages=0, duration=None, rate=None, status=None))
+        metrics['status'] = status
+        if status == 'error':
+            metrics['failures'] += 1
+            failures = self._backoff.get(server, (0, 0))[0] + 1
+            delay = min(self.retry_delay * 2 ** (failures - 1), self.retry_max_delay)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self._backoff[server] = (failures, time.monotonic() + delay)
+            log.info(f'History synchronization of {account.id} failed, {server} will be contacted again in {delay:.0f} seconds')
+            self._rerun.add(account.id)
+        elif status == 'done':
+            self._backoff.pop(server, None)
+            self._last_sync[account.id] = time.monotonic()
+            rate = messages / duration if duration else None
+            metrics.update(synchronizations=metrics['synchronizations'] + 1, messages=metrics['messages'] + messages, duration=duration, rate=rate)
+            log.info(f'History synchronization of {account.id} fetched {messages} messages in {duration:.2f} seconds' + (f' ({rate:.0f} messages/s)' if rate else ''))
+
+        NotificationCenter().post_notification('BlinkServerHistorySyncDidEnd', sender=account, data=NotificationData(status=status, messages=messages, duration=duration, server=server, metrics=dict(metrics)))
+
+        if account.id in self._rerun:
+            self._rerun.discard(account.id)
+            self.schedule(account, force=True)
+        self._start_jobs()
+
+
+class ComposingThrottle(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.timestamp = time.monotonic()
+        self.sent_state = None
+        self.pending = None  # the latest indication not sent yet, supersedes the earlier ones
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+
+
+class SignallingAggregator(object):
+    """Coalesces disposition notifications and throttles is-composing indications before they are sent"""
+
+    imdn_delay = 100  # ms to wait for more notifications before sending them
+    imdn_batch_size = 50  # notifications sent per interval
+    composing_burst = 2  # indications a session can send back to back
+    composing_rate = 0.5  # indications per second once the burst is used up
+
+    __state_rank__ = {'delivered': 0, 'displayed': 1, 'error': 1}
+
+    def __init__(self, manager):
+        self.manager = manager
+        # The aggregator state is only used in the GUI thread
+        self._imdn_queue = {}  # (session, account, message id) -> (timestamp, state)
+        self._read_queue = {}  # sessions whose conversation was read, in order
+        self._composing = {}
+        self._imdn_timer = QTimer()
+        self._imdn_timer.setSingleShot(True)
+        self._imdn_timer.setInterval(self.imdn_delay)
+        self._imdn_timer.timeout.connect(self._SH_IMDNTimerTimeout)
+
+    @run_in_gui_thread
+    def queue_imdn(self, session, id, timestamp, state, account=None):
+        key = session, account, id
+        try:
+            queued_timestamp, queued_state = self._imdn_queue[key]
+        except KeyError:
+            pass
+        else:
+            # a message that was displayed need not be reported as delivered anymore
+            if self.__state_rank__[queued_state] > self.__state_rank__[state]:
+                return
+        self._imdn_queue[key] = timestamp, state
+        if not self._imdn_timer.isActive():
+            self._imdn_timer.start()
+
+    @run_in_gui_thread
+    def queue_conversation_read(self, session):
+        self._read_queue[session] = None
+        if not self._imdn_timer.isActive():
+            self._imdn_timer.start()
+
+    @run_in_gui_thread
+    def send_composing_indication(self, session, state, refresh=None, last_active=None):
+        try:
+            throttle = self._composing[session]
+        except KeyError:
+            throttle = self._composing[session] = ComposingThrottle(self.composing_burst)
+            throttle.timer.timeout.connect(partial(self._send_composing_indication, session, throttle))
+        throttle.pending = state, refresh, last_active
+        self._send_composing_indication(session, throttle, throttled=False)
+
+    def _send_composing_indication(self, session, throttle, throttled=True):
+        if throttle.pending is None:
+            return
+        if throttled and throttle.pending[0] == throttle.sent_state:
+            # the changes made while throttled cancelled each other out
+            throttle.pending = None
+            return
+        now = time.monotonic()
+        throttle.tokens = min(self.composing_burst, throttle.tokens + (now - throttle.timestamp) * self.composing_rate)
+        throttle.timestamp = now
+        if throttle.tokens >= 1:
+            throttle.tokens -= 1
+            state, refresh, last_active = throttle.pending
+            throttle.pending = None
+            throttle.sent_state = state
+            self.manager._send_composing_indication(session, state, refresh, last_active)
+        elif not throttle.timer.isActive():
+            throttle.timer.start(int((1 - throttle.tokens) / self.composing_rate * 1000) + 1)
+
+    @run_in_gui_thread
+    def discard(self, session):
+        throttle = self._composing.pop(session, None)
+        if throttle is not None:
+            throttle.timer.stop()
+        if session in self._read_queue:
+            del self._read_queue[session]
+            self.manager._send_conversation_read(session)
+        for key in [key for key in self._imdn_queue if key[0] is session]:
+            timestamp, state = self._imdn_queue.pop(key)
+            self.manager._send_imdn_message(session, key[2], timestamp, state, key[1])
+
+    def _SH_IMDNTimerTimeout(self):
+        while self._read_queue:
+            session = next(iter(self._read_queue))
+            del self._read_queue[session]
+            self.manager._send_conversation_read(session)
+        for key in list(self._imdn_queue)[:self.imdn_batch_size]:
+            session, account, id = key
+            timestamp, state = self._imdn_queue.pop(key)
+            self.manager._send_imdn_message(session, id, timestamp, state, account)
+        if self._imdn_queue:
+            self._imdn_timer.start()
+
+
 @implementer(IObserver)
 class MessageManager(object, metaclass=Singleton):
     __ignored_content_types__ = {IsComposingDocument.content_type, IMDNDocument.content_type,
                                  'text/pgp-public-key', 'text/pgp-private-key', 'application/sylk-message-remove', 'application/sylk-api'}
 
+    history_page_size = 1000  # messages requested from the server at once
+    history_batch_size = 200  # messages processed between two checkpoints
+
     def __init__(self):
         self.sessions = []
+        self._session_index = {}  # lookup key -> sessions, in the order they were indexed
+        self._session_keys = {}   # session -> lookup keys it is indexed under
+        self._session_lock = Lock()  # the index is changed in the GUI thread and looked up by the history synchronization
         self._outgoing_message_queue = deque()
         self._incoming_encrypted_message_queue = deque()
-        self._sync_queue = deque()
         self.pgp_requests = RequestList()
+        self.history_sync = HistorySyncScheduler(self)
+        self.signalling = SignallingAggregator(self)
 
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='SIPEngineGotMessage')
         notification_center.add_observer(self, name='BlinkSessionWasCreated')
         notification_center.add_observer(self, name='BlinkSessionWasLoaded')
         notification_center.add_observer(self, name='BlinkSessionWasDeleted')
+        notification_center.add_observer(self, name='BlinkSessionNewIncoming')
+        notification_center.add_observer(self, name='BlinkSessionNewOutgoing')
+        notification_center.add_observer(self, name='BlinkSessionDidReinitializeForIncoming')
+        notification_center.add_observer(self, name='BlinkSessionDidReinitializeForOutgoing')
+        notification_center.add_observer(self, name='BlinkSessionContactDidChange')
         notification_center.add_observer(self, name='PGPKeysDidGenerate')
         notification_center.add_observer(self, name='PGPMessageDidNotDecrypt')
         notification_center.add_observer(self, name='PGPMessageDidDecrypt')
         notification_center.add_observer(self, name='PGPKeysShouldReload')
         notification_center.add_observer(self, name='SIPAccountRegistrationDidSucceed')
-        notification_center.add_observer(self, name='BlinkServerHistoryWasFetched')
         notification_center.add_observer(self, name='BlinkMessageHistoryFailedLocalFound')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange')
 
+    @staticmethod
+    def _normalize_uri(uri):
+        uri = str(uri)
+        return uri[4:] if uri.startswith('sip:') else uri
+
+    def _get_session_keys(self, session):
+        keys = set()
+        if session.contact is not None:
+            # contacts are matched by identity of their settings, dummy contacts have no id
+            keys.add(('contact', id(session.contact.settings)))
+            keys.update(('contact-uri', uri.id) for uri in session.contact.uris)
+        if session.contact_uri is not None:
+            keys.add(('uri', self._normalize_uri(session.contact_uri.uri)))
+        if session.remote_instance_id:
+            keys.add(('instance', session.remote_instance_id))
+        return keys
+
+    def _index_session(self, session):
+        new_keys = self._get_session_keys(session)
+        with self._session_lock:
+            old_keys = self._session_keys.get(session, set())
+            for key in old_keys - new_keys:
+                self._unindex_key(key, session)
+            for key in new_keys - old_keys:
+                self._session_index.setdefault(key, []).append(session)
+            self._session_keys[session] = new_keys
+
+    def _unindex_session(self, session):
+        with self._session_lock:
+            for key in self._session_keys.pop(session, ()):
+                self._unindex_key(key, session)
+
+    def _unindex_key(self, key, session):
+        sessions = self._session_index[key]
+        sessions.remove(session)
+        if not sessions:
+            del self._session_index[key]
+
+    def find_session(self, contact=None, contact_uri=None, instance_id=None, contact_uri_id=None):
+        """Return the session opened for the contact, its URI or its instance, or raise StopIteration"""
+        keys = []
+        if contact is not None:
+            keys.append(('contact', id(contact.settings)))
+        if contact_uri is not None:
+            keys.append(('uri', self._normalize_uri(contact_uri.uri)))
+        if instance_id:
+            keys.append(('instance', instance_id))
+        if contact_uri_id is not None:
+            keys.append(('contact-uri', contact_uri_id))
+        with self._session_lock:
+            for key in keys:
+                try:
+                    return self._session_index[key][0]
+                except (KeyError, IndexError):
+                    pass
+        raise StopIteration
+
     @run_in_thread('file-io')
     def _save_pgp_key(self, data, uri):
         log.info(f'Saving public key for {str(uri)[4:]}')
@@ -690,15 +1104,17 @@ class MessageManager(object, metaclass=Singleton):
         with open(filename, 'wb') as f:
             data = data if isinstance(data, bytes) else data.encode()
             f.write(data)
-            try:
-                from blink.contacts import URIUtils
-                contact, contact_uri = URIUtils.find_contact(uri)
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
-            except StopIteration:
-                pass
-            else:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('PGPKeysShouldReload', sender=blink_session)
+        PGPKeyCache().invalidate(filename)
+
+        try:
+            from blink.contacts import URIUtils
+            contact, contact_uri = URIUtils.find_contact(uri)
+            blink_session = self.find_session(contact)
+        except StopIteration:
+            pass
+        else:
+            notification_center = NotificationCenter()
+            notification_center.post_notification('PGPKeysShouldReload', sender=blink_session)
 
     def check_encryption(self, content_type, body):
         if (content_type.lower().startswith('text/') and '-----BEGIN PGP MESSAGE-----' in body and body.strip().endswith('-----END PGP MESSAGE-----') and content_type != 'text/pgp-private-key'):
@@ -716,7 +1132,7 @@ class MessageManager(object, metaclass=Singleton):
         filename = os.path.join(directory, f'{id}.{extension}')
         if os.path.exists(filename):
             try:
-                key1, _ = pgpy.PGPKey.from_file(filename)
+                key1 = PGPKeyCache().get(filename)
                 key2, _ = pgpy.PGPKey.from_blob(public_key)
             except Exception as e:
                 log.warning(f"Can't load PGP key for comparison: {str(e)}")
@@ -762,74 +1178,124 @@ class MessageManager(object, metaclass=Singleton):
             message = self._outgoing_message_queue.popleft()
             message.send()
 
+    def _run_serialized(self, function, *args):
+        # The history of several accounts is fetched at the same time, but everything that touches the accounts, the sessions
+        # or the outgoing message queue runs on the single sync thread, one call at a time, and the fetching thread waits for it
+        future = Future()
+        self._call_in_sync_thread(future, function, *args)
+        return future.result()
+
     @run_in_thread('sync')
+    def _call_in_sync_thread(self, future, function, *args):
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _save_history_synchronization_timestamp(self, account, timestamp):
+        account.sms.history_synchronization_timestamp = timestamp
+        account.save()
+
     def _sync_messages(self, account):
+        # Runs on a thread of the history synchronization scheduler, returns the outcome and the number of messages fetched.
+        # Only the requests to the server run concurrently, the fetched messages are processed through _run_serialized.
         if not account.sms.enable_history_synchronization:
             if account.sms.history_synchronization_timestamp:
-                account.sms.history_synchronization_timestamp = None
-                account.save()
-            return
+                self._run_serialized(self._save_history_synchronization_timestamp, account, None)
+            return 'skipped', 0
 
         if not account.sms.history_synchronization_token:
-            self._request_history_synchronization_token(account)
-            return
+            self._run_serialized(self._request_history_synchronization_token, account)
+            return 'token', 0
 
         if not account.sms.history_synchronization_url:
-            return
-
-        if account.sms.history_synchronization_id is not None:
-            url = urllib.parse.urljoin(f'{account.sms.history_synchronization_url}/', account.sms.history_synchronization_id)
-        else:
-            url = account.sms.history_synchronization_url
+            return 'skipped', 0
 
-        scheme, netloc, path, query, fragment = urlsplit(url)
-        path = quote(path)
-        url = urlunsplit((scheme, netloc, path, query, fragment))
         headers = {'Authorization': f'Apikey {account.sms.history_synchronization_token}'}
 
-        if account.sms.history_synchronization_timestamp is not None:
-            last_sync = ISOTimestamp(account.sms.history_synchronization_timestamp)
-            expired_time = ISOTimestamp.now() - last_sync
-            if expired_time.total_seconds() < 500:
-                log.debug(f'History synchronization skipped for {account.id}, will only sync on interval > 500s ({expired_time.total_seconds()})')
-                return
+        last_id = account.sms.history_synchronization_id
+        total = 0
 
-        log.info(f'Fetching message history for {account.id} from server {url}')
+        # Each page starts after the last message received, servers that do not limit the page size send everything at once
+        while True:
+            if last_id is not None:
+                url = urllib.parse.urljoin(f'{account.sms.history_synchronization_url}/', last_id)
+            else:
+                url = account.sms.history_synchronization_url
 
-        settings = SIPSimpleSettings()
+            scheme, netloc, path, query, fragment = urlsplit(url)
+            path = quote(path)
+            url = urlunsplit((scheme, netloc, path, query, fragment))
 
-        try:
-            r = requests.get(url, headers=headers, timeout=10, verify=settings.tls.verify_server)
+            log.info(f'Fetching message history for {account.id} from server {url}')
+
+            count = 0
+            batch = deque()
+            # The messages are processed in batches while the rest of the page is being received, only the fetch is guarded
+            # so that a failure to process a batch is not mistaken for a failure of the server
+            with closing(self._fetch_server_history(url, headers)) as messages:
+                while True:
+                    try:
+                        message = next(messages)
+                    except StopIteration:
+                        break
+                    except (requests.ConnectionError, requests.Timeout) as e:
+                        log.warning(f'SylkServer API connection error: {e}')
+                        self._process_server_history_batch(account, batch, last_id)
+                        return 'error', total + count
+                    except requests.HTTPError as e:
+                        code = e.response.status_code
+                        if code == 401:
+                            log.debug('SylkServer API token expired')
+                            self._run_serialized(self._request_history_synchronization_token, account)
+                            return 'token', total + count
+                        log.warning(f'SylkServer API error {e}')
+                        return 'error', total + count
+                    except requests.RequestException as e:
+                        log.warning(f'SylkServer API error {e}')
+                        self._process_server_history_batch(account, batch, last_id)
+                        return 'error', total + count
+                    except ValueError as e:
+                        # A batch that was completely received is processed even if the rest of the page is invalid
+                        log.warning(f'SylkServer API returned an invalid message history: {e}')
+                        self._process_server_history_batch(account, batch, last_id)
+                        return 'error', total + count
+                    batch.append(message)
+                    count += 1
+                    if len(batch) == self.history_batch_size:
+                        last_id = self._process_server_history_batch(account, batch, last_id)
+            last_id = self._process_server_history_batch(account, batch, last_id)
+
+            total += count
+            if count < self.history_page_size:
+                break
+
+        log.info(f'Fetched {total} messages from server history for {account.id}')
+        self._run_serialized(self._save_history_synchronization_timestamp, account, ISOTimestamp.now())
+        return 'done', total
+
+    def _fetch_server_history(self, url, headers):
+        settings = SIPSimpleSettings()
+        with requests.get(url, headers=headers, params={'limit': self.history_page_size}, timeout=10, verify=settings.tls.verify_server, stream=True) as r:
             r.raise_for_status()
-        except (requests.ConnectionError, requests.Timeout) as e:
-            log.warning(f'SylkServer API connection error: {e}')
-        except requests.HTTPError as e:
-            code = e.response.status_code
-            if code == 401:
-                log.debug('SylkServer API token expired')
-                self._request_history_synchronization_token(account)
-                return
-            log.warning(f'SylkServer API error {e}')
-        except requests.RequestException as e:
-            log.warning(f'SylkServer API error {e}')
-        else:
-            try:
-                data = r.json()
-            except ValueError:
-                pass
-            else:
-                notification_center = NotificationCenter()
-                notification_center.post_notification('BlinkServerHistoryWasFetched', sender=account, data=data)
+            yield from iter_json_array(r.iter_content(chunk_size=65536), 'messages')
+
+    def _process_server_history_batch(self, account, batch, last_id):
+        # Returns the id of the last message processed so far, which is the checkpoint the synchronization continues from
+        if not batch:
+            return last_id
+        last_id = self._run_serialized(self._process_server_history_messages, account, batch) or last_id
+        NotificationCenter().post_notification('BlinkServerHistoryBatchDidEnd', sender=account, data=NotificationData(last_id=last_id))
+        return last_id
 
-    @run_in_thread('sync')
     def _process_server_history_messages(self, account, messages):
+        # Runs on the sync thread, returns the id of the last message so that the synchronization can continue after it
         notification_center = NotificationCenter()
         last_id = None
-        new_messages = 0
 
         log.debug(f'-- {len(messages)} messages fetched from server for {account.id}')
         while messages:
-            message = messages.pop(0)
+            message = messages.popleft()
             last_id = message['message_id']
             content_type = message['content_type'].lower()
 
@@ -841,7 +1307,7 @@ class MessageManager(object, metaclass=Singleton):
                 from blink.contacts import URIUtils
                 contact, contact_uri = URIUtils.find_contact(message['contact'])
                 try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                    blink_session = self.find_session(contact)
                 except StopIteration:
                     pass
                 else:
@@ -853,7 +1319,7 @@ class MessageManager(object, metaclass=Singleton):
                 contact, contact_uri = URIUtils.find_contact(message['content'])
                 timestamp = ISOTimestamp(message['timestamp'])
                 try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                    blink_session = self.find_session(contact)
                 except StopIteration:
                     notification_center.post_notification('BlinkGotHistoryConversationRemove', sender=account, data=NotificationData(contact=contact_uri.uri, timestamp=timestamp))
                 else:
@@ -865,7 +1331,7 @@ class MessageManager(object, metaclass=Singleton):
                 from blink.contacts import URIUtils
                 contact, contact_uri = URIUtils.find_contact(message['contact'])
                 try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                    blink_session = self.find_session(contact)
                 except StopIteration:
                     pass
                 else:
@@ -926,11 +1392,8 @@ class MessageManager(object, metaclass=Singleton):
                                                         encryption='OpenPGP' if is_secure else None)
 
                 notification_center.post_notification('BlinkGotHistoryMessage', sender=account, data=history_message_data)
-                if message['direction'] == 'incoming':
-                    NotificationCenter().post_notification('BlinkMessageNewUnread', sender=contact.uri.uri)
-
                 try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                    blink_session = self.find_session(contact)
                 except StopIteration:
                     continue
 
@@ -979,11 +1442,8 @@ class MessageManager(object, metaclass=Singleton):
                                                           encryption=encryption,
                                                           state=message['state']))
 
-                if message['direction'] == 'incoming':
-                    NotificationCenter().post_notification('BlinkMessageNewUnread', sender=contact.uri.uri)
-
                 try:
-                    blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                    blink_session = self.find_session(contact)
                 except StopIteration:
                     pass
                 else:
@@ -1003,11 +1463,7 @@ class MessageManager(object, metaclass=Singleton):
                         else:
                             self._incoming_encrypted_message_queue.append((history_message, account, contact))
 
-        if last_id is not None:
-            account.sms.history_synchronization_id = last_id
-        account.sms.history_synchronization_timestamp = ISOTimestamp.now()
-        account.save()
-
+        return last_id
 
     @run_in_gui_thread
     def handle_notification(self, notification):
@@ -1044,6 +1500,10 @@ class MessageManager(object, metaclass=Singleton):
         with open(f'{filename}.pubkey', 'wb') as f:
             f.write(str(public_key).encode())
 
+        key_cache = PGPKeyCache()
+        key_cache.invalidate(f'{filename}.privkey')
+        key_cache.invalidate(f'{filename}.pubkey')
+
         request.account.sms.private_key = f'{filename}.privkey'
         request.account.sms.public_key = f'{filename}.pubkey'
         request.account.save()
@@ -1056,7 +1516,7 @@ class MessageManager(object, metaclass=Singleton):
         while self._incoming_encrypted_message_queue:
             message, account, contact = self._incoming_encrypted_message_queue.popleft()
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = self.find_session(contact)
             except StopIteration:
                 pass
             else:
@@ -1084,14 +1544,11 @@ class MessageManager(object, metaclass=Singleton):
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         if isinstance(notification.sender, Account) and 'sms.enable_history_synchronization' in notification.data.modified:
-            self._sync_messages(notification.sender)
+            self.history_sync.schedule(notification.sender, force=True)
 
     def _NH_SIPAccountRegistrationDidSucceed(self, notification):
         if notification.sender is not BonjourAccount():
-            self._sync_queue.append(notification.sender)
-            while self._sync_queue:
-                sender = self._sync_queue.popleft()
-                self._sync_messages(sender)
+            self.history_sync.schedule(notification.sender)
 
     def _NH_SIPEngineGotMessage(self, notification):
         account_manager = AccountManager()
@@ -1175,7 +1632,7 @@ class MessageManager(object, metaclass=Singleton):
             account.sms.history_synchronization_url = url
             account.sms.history_synchronization_timestamp = None
             account.save()
-            self._sync_messages(account)
+            self.history_sync.schedule(account, force=True)
             return
 
         if content_type.lower() == 'text/pgp-private-key':
@@ -1224,7 +1681,7 @@ class MessageManager(object, metaclass=Singleton):
             notification_center.post_notification('BlinkGotHistoryMessageDelete', data=payload['message_id'])
 
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = self.find_session(contact)
             except StopIteration:
                 pass
             else:
@@ -1241,7 +1698,7 @@ class MessageManager(object, metaclass=Singleton):
             contact, contact_uri = URIUtils.find_contact(payload['contact'])
             timestamp = ISOTimestamp(payload['timestamp'])
             try:
-                blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+                blink_session = self.find_session(contact)
             except StopIteration:
                 notification_center.post_notification('BlinkGotHistoryConversationRemove', sender=account, data=NotificationData(contact=contact_uri.uri, timestamp=timestamp))
             else:
@@ -1263,7 +1720,7 @@ class MessageManager(object, metaclass=Singleton):
             message.direction = "outgoing"
 
         try:
-            blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings or (instance_id and instance_id == session.remote_instance_id))
+            blink_session = self.find_session(contact, instance_id=instance_id)
         except StopIteration:
             blink_session = None
             if any(content_type.lower().startswith(prefix) for prefix in self.__ignored_content_types__):
@@ -1422,24 +1879,33 @@ class MessageManager(object, metaclass=Singleton):
 
         self._handle_incoming_message(message, blink_session, account)
 
-    def _NH_BlinkServerHistoryWasFetched(self, notification):
-        account = notification.sender
-        messages = notification.data['messages']
-        self._process_server_history_messages(account, messages)
-
     def _NH_BlinkSessionWasCreated(self, notification):
         session = notification.sender
         self.sessions.append(session)
+        self._index_session(session)
 
     def _NH_BlinkSessionWasDeleted(self, notification):
         session = notification.sender
         self.sessions.remove(session)
+        self._unindex_session(session)
+        self.signalling.discard(session)
         for request in self.pgp_requests[session.account, GeneratePGPKeyRequest]:
             request.dialog.hide()
             self.pgp_requests.remove(request)
 
+    def _NH_BlinkSessionNewIncoming(self, notification):
+        if notification.sender in self._session_keys:
+            self._index_session(notification.sender)
+
+    _NH_BlinkSessionNewOutgoing = _NH_BlinkSessionNewIncoming
+    _NH_BlinkSessionDidReinitializeForIncoming = _NH_BlinkSessionNewIncoming
+    _NH_BlinkSessionDidReinitializeForOutgoing = _NH_BlinkSessionNewIncoming
+    _NH_BlinkSessionContactDidChange = _NH_BlinkSessionNewIncoming
+
     def _NH_BlinkSessionWasLoaded(self, notification):
         session = notification.sender
+        if session in self._session_keys:
+            self._index_session(session)
         stream = session.fake_streams.get('messages')
 
         if stream is None:
@@ -1543,7 +2009,7 @@ class MessageManager(object, metaclass=Singleton):
             instance_id = contact.settings.id if contact.type == 'bonjour' else None
 
             try:
-                blink_session = next(session for session in self.sessions if session.contact_uri.uri == contact_uri.uri or (instance_id and instance_id == session.remote_instance_id))
+                blink_session = self.find_session(contact_uri=contact_uri, instance_id=instance_id)
             except StopIteration:
                 log.info(f"Create message view from history for {contact_uri.uri} with instance_id {instance_id}")
                 created_views.add(contact_uri.uri)
@@ -1581,6 +2047,9 @@ class MessageManager(object, metaclass=Singleton):
         filename = os.path.join(directory, account.id)
         os.rename(f'{filename}.privkey', f'{filename}-{timestamp}-old.privkey')
         os.rename(f'{filename}.pubkey', f'{filename}-{timestamp}-old.pubkey')
+        key_cache = PGPKeyCache()
+        key_cache.invalidate(f'{filename}.privkey')
+        key_cache.invalidate(f'{filename}.pubkey')
 
         account.sms.public_key = None
         account.sms.private_key = None
@@ -1610,6 +2079,9 @@ class MessageManager(object, metaclass=Singleton):
         if not session.account.sms.enable_iscomposing:
             return
 
+        self.signalling.send_composing_indication(session, state, refresh, last_active)
+
+    def _send_composing_indication(self, session, state, refresh=None, last_active=None):
         content = IsComposingDocument.create(state=State(state),
                                              refresh=Refresh(refresh) if refresh is not None else None,
                                              last_active=LastActive(last_active) if last_active is not None else None,
@@ -1623,6 +2095,9 @@ class MessageManager(object, metaclass=Singleton):
         self._send_message(outgoing_message)
 
     def send_conversation_read(self, session):
+        self.signalling.queue_conversation_read(session)
+
+    def _send_conversation_read(self, session):
         contact = str(session.contact.uri.uri)
         payload = {'contact': contact}
         content = json.dumps(payload)
@@ -1651,6 +2126,9 @@ class MessageManager(object, metaclass=Singleton):
             if not account.sms.use_cpim or not account.sms.enable_imdn:
                 return
 
+        self.signalling.queue_imdn(session, id, timestamp, state, account)
+
+    def _send_imdn_message(self, session, id, timestamp, state, account=None):
         log.debug(f"Message {id} imdn sending: {state}")
         if state == 'delivered':
             notification = DeliveryNotification(state)
@@ -1668,7 +2146,7 @@ class MessageManager(object, metaclass=Singleton):
         self._send_message(outgoing_message)
 
     def send_message(self, account, contact, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None, id=None):
-        blink_session = next(session for session in self.sessions if session.contact.settings is contact.settings)
+        blink_session = self.find_session(contact)
         blink_session.last_failed_reason = None
         blink_session.updateTimestamp()
         outgoing_message = OutgoingMessage(account, contact, content, content_type, recipients, courtesy_recipients, subject, timestamp, required, additional_headers, id, blink_session)
@@ -1683,7 +2161,7 @@ class MessageManager(object, metaclass=Singleton):
         instance_id = contact.settings.id if contact.type == 'bonjour' else None
 
         try:
-            blink_session = next(session for session in self.sessions if session.contact_uri.uri == contact_uri.uri or (contact.type == 'dummy' and uri in session.contact.uris))
+            blink_session = self.find_session(contact_uri=contact_uri, contact_uri_id=uri if contact.type == 'dummy' else None)
         except StopIteration:
             log.info(f"Create message view from session for {contact_uri.uri} with instance_id {instance_id}")
             try:
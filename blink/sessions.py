@@ -6833,7 +6833,15 @@ class SessionManager(object, metaclass=Singleton):
 
         if os.path.exists(full_filepath):
             message_log.info(f"File {file.id} already downloaded {full_filepath}")
-            notification_center.post_notification('BlinkHTTPFileTransferDidEnd', sender=session, data=NotificationData(file=file, must_open=must_open))
+            notification_center.post_notification('BlinkHTTPFileTransferDidEnd', sender=session, data=NotificationData(file=file, must_open=must_open, content_key=None))
+            return
+
+        from blink.history import DownloadHistory
+        download_history = DownloadHistory()
+        content_key = download_history.link_cached_file(file.hash, full_filepath)
+        if content_key is not None:
+            message_log.info(f"File {file.id} was already downloaded in another conversation {full_filepath}")
+            notification_center.post_notification('BlinkHTTPFileTransferDidEnd', sender=session, data=NotificationData(file=file, must_open=must_open, content_key=content_key))
             return
 
         if os.path.exists(tmp_path):
@@ -6883,10 +6891,11 @@ class SessionManager(object, metaclass=Singleton):
                     return
 
             os.rename(tmp_path, full_filepath)
+            content_key = download_history.store_cached_file(file.hash, full_filepath)
 
             message_log.info(f'File {file.id} downloaded {current_bytes} bytes saved to {file.name} size {os.path.getsize(full_filepath)}')
             notification_center.post_notification('BlinkHTTPTransferCompleted', sender=file)
-            notification_center.post_notification('BlinkHTTPFileTransferDidEnd', sender=session, data=NotificationData(file=file, must_open=must_open))
+            notification_center.post_notification('BlinkHTTPFileTransferDidEnd', sender=session, data=NotificationData(file=file, must_open=must_open, content_key=content_key))
 
     def update_ringtone(self):
         settings = SIPSimpleSettings()
@@ -1,7 +1,13 @@
+import heapq
 import os
 
+from itertools import count
+from threading import Lock, local
+
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null
+from application.python.threadpool import ThreadPool
+from application.python.types import Singleton
 from application.system import makedirs, unlink, openfile, FileExistsError
 
 from otr import OTRTransport
@@ -23,7 +29,124 @@ from blink.logging import MessagingTrace as log
 from blink.util import run_in_gui_thread, UniqueFilenameGenerator
 
 
-__all__ = ['MessageStream']
+__all__ = ['MessageStream', 'DecryptionPool', 'PGPKeyCache']
+
+
+class PGPKeyCache(object, metaclass=Singleton):
+    """PGP keys loaded from files, shared until the file changes on disk"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._keys = {}  # filename -> ((mtime, size), key)
+
+    def get(self, filename):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            self.invalidate(filename)
+            return None
+        signature = stat.st_mtime_ns, stat.st_size
+        with self._lock:
+            try:
+                key_signature, key = self._keys[filename]
+            except KeyError:
+                pass
+            else:
+                if key_signature == signature:
+                    return key
+        key, _ = PGPKey.from_file(filename)
+        with self._lock:
+            self._keys[filename] = signature, key
+        return key
+
+    def invalidate(self, filename=None):
+        with self._lock:
+            if filename is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(filename, None)
+
+
+class DecryptionPool(object, metaclass=Singleton):
+    """Decrypts PGP messages on several threads, the newest ones of the active conversation first"""
+
+    max_threads = 4
+    max_worker_keys = 32  # key copies kept by every worker thread
+
+    def __init__(self):
+        self.pool = ThreadPool(name='pgp-decrypt', min_threads=1, max_threads=min(os.cpu_count() or 1, self.max_threads))
+        self.pool.start()
+        self.active_session = None
+        self._lock = Lock()
+        self._queue = []  # (priority, sequence, stream, message)
+        self._sequence = count()
+        self._results = []
+        self._posting = False
+        self._worker = local()
+
+    def _worker_key(self, key):
+        # Keys are shared by the streams of all sessions, every worker thread decrypts with its own copy of them
+        try:
+            keys = self._worker.keys
+        except AttributeError:
+            keys = self._worker.keys = {}
+        try:
+            original, copy = keys[id(key)]
+        except KeyError:
+            original = None
+        if original is not key:
+            if len(keys) >= self.max_worker_keys:
+                keys.clear()
+            copy, _ = PGPKey.from_blob(str(key))
+            keys[id(key)] = key, copy
+        return copy
+
+    def _priority(self, stream, sequence):
+        # later messages are closer to the bottom of the chat, where it is scrolled to
+        return stream.blink_session is not self.active_session, -sequence
+
+    def decrypt(self, stream, message):
+        with self._lock:
+            sequence = next(self._sequence)
+            heapq.heappush(self._queue, (self._priority(stream, sequence), sequence, stream, message))
+        self.pool.run(self._decrypt_next)
+
+    def prioritize(self, blink_session):
+        with self._lock:
+            self.active_session = blink_session
+            self._queue = [(self._priority(stream, sequence), sequence, stream, message) for priority, sequence, stream, message in self._queue]
+            heapq.heapify(self._queue)
+
+    def _decrypt_next(self):
+        # every job decrypts the most urgent message queued at the time it runs
+        with self._lock:
+            priority, sequence, stream, message = heapq.heappop(self._queue)
+        try:
+            result = stream._decrypt(message, self._worker_key)
+        except Exception as e:
+            log.exception(f'Decryption of message failed: {e}')
+            return
+        if result is None:
+            return
+        with self._lock:
+            self._results.append(result)
+            if self._posting:
+                return
+            self._posting = True
+        self._post_results()
+
+    @run_in_gui_thread
+    def _post_results(self):
+        # the results that arrived until the GUI thread got here are posted together
+        with self._lock:
+            results, self._results = self._results, []
+            self._posting = False
+        notification_center = NotificationCenter()
+        for name, sender, data, content in results:
+            # messages are only modified on the GUI thread, where they are also displayed
+            if content is not None:
+                data.message.content = content
+            notification_center.post_notification(name, sender=sender, data=data)
 
 
 @implementer(IMediaStream, IObserver)
@@ -156,6 +279,10 @@ class MessageStream(object, metaclass=MediaStreamType):
         with open(f'{filename}.pubkey', 'wb') as f:
             f.write(str(private_key.pubkey).encode())
 
+        key_cache = PGPKeyCache()
+        key_cache.invalidate(f'{filename}.privkey')
+        key_cache.invalidate(f'{filename}.pubkey')
+
         session.account.sms.private_key = f'{filename}.privkey'
         session.account.sms.public_key = f'{filename}.pubkey'
         session.account.save()
@@ -239,14 +366,15 @@ class MessageStream(object, metaclass=MediaStreamType):
         del sessionkey
         return str(encrypted_content)
 
-    @run_in_thread('pgp')
     def decrypt(self, message):
+        DecryptionPool().decrypt(self, message)
+
+    def _decrypt(self, message, worker_key):
+        # Runs on a thread of the decryption pool, returns the notification to post and the decrypted content
         session = self.blink_session
-        notification_center = NotificationCenter()
 
         if self.private_key is None and len(self.other_private_keys) == 0:
-            notification_center.post_notification('PGPMessageDidNotDecrypt', sender=session, data=NotificationData(message=message, error='No private key'))
-            return
+            return 'PGPMessageDidNotDecrypt', session, NotificationData(message=message, error='No private key'), None
 
         try:
             msg_id = message.message_id
@@ -257,7 +385,7 @@ class MessageStream(object, metaclass=MediaStreamType):
             pgpMessage = PGPMessage.from_blob(message.content)
         except (ValueError, NotImplementedError) as e:
             log.warning(f'Decryption error for {msg_id}, not a PGPMessage: {e}')
-            return
+            return None
 
         key_list = [(session.account, self.private_key)] if self.private_key is not None else []
         key_list.extend(self.other_private_keys)
@@ -265,23 +393,23 @@ class MessageStream(object, metaclass=MediaStreamType):
         error = None
         for (account, key) in key_list:
             try:
-                decrypted_message = key.decrypt(pgpMessage)
+                decrypted_message = worker_key(key).decrypt(pgpMessage)
             except (PGPDecryptionError, PGPError) as e:
                 error = str(e)
                 #log.debug(f'-- Decryption error for {msg_id} from {session.contact_uri.uri} with {account.id} : {error}')
                 continue
             else:
                 try:
-                    message.content = decrypted_message.message.decode() if isinstance(decrypted_message.message, bytearray) else decrypted_message.message.encode('latin1').decode()
+                    content = decrypted_message.message.decode() if isinstance(decrypted_message.message, bytearray) else decrypted_message.message.encode('latin1').decode()
                 except (UnicodeDecodeError, UnicodeEncodeError) as e:
                     log.debug(f'-- Decoding error for {msg_id} from {session.contact_uri.uri} with {account.id} : {str(e)}')
                 else:
                     #log.info(f'Message decrypted: {msg_id}')
-                    notification_center.post_notification('PGPMessageDidDecrypt', sender=session, data=NotificationData(message=message, account=account))
-                return
+                    return 'PGPMessageDidDecrypt', session, NotificationData(message=message, account=account), content
+                return None
 
         log.debug(f'-- Message {msg_id} from {session.contact_uri.uri} decryption error: {error}')
-        notification_center.post_notification('PGPMessageDidNotDecrypt', sender=session, data=NotificationData(message=message, error=error))
+        return 'PGPMessageDidNotDecrypt', session, NotificationData(message=message, error=error), None
 
     @run_in_thread('pgp')
     def encrypt_file(self, filename, transfer_session):
@@ -378,11 +506,8 @@ class MessageStream(object, metaclass=MediaStreamType):
             directory = settings.chat.keys_directory.normalized
 
         filename = os.path.join(directory, f'{id}.{extension}')
-        if not os.path.exists(filename):
-            return loaded_key
-
         try:
-            loaded_key, _ = PGPKey.from_file(filename)
+            loaded_key = PGPKeyCache().get(filename)
         except Exception as e:
             log.warning(f"Can't load PGP key: {str(e)}")
 